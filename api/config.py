@@ -0,0 +1,45 @@
+import os
+
+DATA_DIR = "./data/astrovisio_files"
+
+# Columnar cache of converted source variables, keyed by file fingerprint
+RAW_CACHE_DIR = os.path.join(DATA_DIR, "raw_cache")
+RAW_CACHE_ENABLED = os.getenv("RAW_CACHE_ENABLED", "true").lower() != "false"
+
+# Processed outputs, addressed by a hash of the file fingerprint and settings
+ARTIFACTS_DIR = os.path.join(DATA_DIR, "artifacts")
+DOWNSAMPLING_SEED = int(os.getenv("DOWNSAMPLING_SEED", "42"))
+CACHE_BUDGET_BYTES = int(float(os.getenv("CACHE_BUDGET_GB", "50")) * 1024**3)
+
+# Chunks published by running jobs before their artifact is complete
+PARTIAL_DIR = os.path.join(DATA_DIR, "partial")
+
+# Worker processes running queued processing jobs
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "2"))
+
+# Pre-process new files at low priority with default settings, so the first
+# process request is likely an artifact cache hit
+SPECULATIVE_PROCESSING = os.getenv("SPECULATIVE_PROCESSING", "false").lower() == "true"
+# Largest file, in points, that is pre-processed speculatively
+SPECULATIVE_MAX_POINTS = int(float(os.getenv("SPECULATIVE_MAX_POINTS", "1e6")))
+
+
+def _memory_limit() -> int:
+    """Physical memory, or the container's cgroup limit when lower."""
+    limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            cgroup_limit = f.read().strip()
+        if cgroup_limit.isdigit():
+            limit = min(limit, int(cgroup_limit))
+    except OSError:
+        pass
+    return limit
+
+
+# Memory that running jobs may use together, by their estimated peak
+MEMORY_BUDGET_BYTES = (
+    int(float(os.environ["MEMORY_BUDGET_GB"]) * 1024**3)
+    if os.getenv("MEMORY_BUDGET_GB")
+    else int(_memory_limit() * 0.75)
+)
@@ -1,18 +1,70 @@
 import os
 
+from sqlalchemy import Column, inspect, literal, text
 from sqlalchemy.orm import sessionmaker
 from sqlmodel import Session, SQLModel, create_engine
 
+from api.config import DATA_DIR
+
 # Ensure data directory exists
-os.makedirs("./data/astrovisio_files", exist_ok=True)
+os.makedirs(DATA_DIR, exist_ok=True)
 
-DATABASE_URL = "sqlite:///./data/astrovisio_files/prod.db"
+DATABASE_URL = f"sqlite:///{DATA_DIR}/prod.db"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# Worker processes write job updates concurrently: wait for locks instead of failing
+engine = create_engine(
+    DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30}
+)
 SessionLocal = sessionmaker(
     class_=Session, autocommit=False, autoflush=False, bind=engine
 )
 
 
+def _add_column_ddl(table: str, column: Column, dialect) -> str:
+    """ALTER TABLE statement adding a model column to an existing table.
+
+    SQLite only adds NOT NULL columns with a default, so columns without a
+    scalar default are added as nullable.
+    """
+    ddl = (
+        f'ALTER TABLE "{table}" ADD COLUMN "{column.name}" '
+        f"{column.type.compile(dialect=dialect)}"
+    )
+    default = column.default
+    if default is not None and default.is_scalar and default.arg is not None:
+        value = literal(default.arg, column.type).compile(
+            dialect=dialect, compile_kwargs={"literal_binds": True}
+        )
+        ddl += f" DEFAULT {value}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    return ddl
+
+
+def upgrade_schema(bind=engine) -> None:
+    """Add the columns and indexes the models gained to existing tables.
+
+    create_all only creates missing tables, so a database written by an
+    earlier version would otherwise fail with "no such column". Existing
+    rows get the columns' defaults.
+    """
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    connection.execute(
+                        text(_add_column_ddl(table.name, column, bind.dialect))
+                    )
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    upgrade_schema()
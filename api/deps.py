@@ -11,6 +11,8 @@ def get_session() -> Generator[Session, None, None]:
     try:
         with Session(engine) as session:
             yield session
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
@@ -61,3 +61,13 @@ class FileProcessingError(APIException):
             detail=f"Failed to process files: {error_details}",
             context={"file_paths": file_paths, "error_details": error_details},
         )
+
+
+class ArtifactProjectionError(APIException):
+    def __init__(self, error_details: str):
+        super().__init__(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            error_code="ARTIFACT_PROJECTION_ERROR",
+            detail=f"Cannot project processed data: {error_details}",
+            context={"error_details": error_details},
+        )
@@ -0,0 +1,118 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set
+
+# Job statuses after which no further events follow
+TERMINAL_STATUSES = ("done", "error", "cancelled")
+# Seconds between keep-alive comments on an idle event stream
+KEEPALIVE_INTERVAL = 15.0
+
+
+class JobEventBroadcaster:
+    """Fans job events out to the event streams watching them.
+
+    Purpose:
+    - Push job progress and status changes to clients instead of having them
+      poll the progress endpoint.
+
+    Responsibilities:
+    - Keep one asyncio queue per stream, registered under the jobs it watches;
+      an idle stream just awaits its queue.
+    - Accept events from any thread (the dispatcher publishes them) and
+      deliver them on the event loop bound at startup.
+    """
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # Only touched on the event loop
+        self.subscribers: Dict[int, Set[asyncio.Queue]] = defaultdict(set)
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+
+    def subscribe(self, job_ids: Iterable[int]) -> asyncio.Queue:
+        """Register a stream for the jobs; call on the event loop."""
+        queue = asyncio.Queue()
+        for job_id in job_ids:
+            self.subscribers[job_id].add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue, job_ids: Iterable[int]) -> None:
+        for job_id in job_ids:
+            queues = self.subscribers.get(job_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.subscribers[job_id]
+
+    def watching(self, job_id: int) -> bool:
+        """Whether a stream watches the job (a racy read is fine from any thread)."""
+        return job_id in self.subscribers
+
+    def publish(self, event: dict) -> None:
+        """Deliver an event with a "job_id" to its watchers; thread-safe."""
+        if self.loop is None or not self.watching(event["job_id"]):
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._deliver, event)
+        except RuntimeError:
+            # The loop was closed during shutdown
+            pass
+
+    def _deliver(self, event: dict) -> None:
+        for queue in self.subscribers.get(event["job_id"], ()):
+            queue.put_nowait(event)
+
+
+def job_event(
+    job_id: int,
+    status: str,
+    progress: float,
+    stage: Optional[str] = None,
+    error: Optional[str] = None,
+    type: str = "status",
+) -> dict:
+    return {
+        "type": type,
+        "job_id": job_id,
+        "status": status,
+        "progress": progress,
+        "stage": stage,
+        "error": error,
+    }
+
+
+def format_event(event: dict) -> str:
+    """Server-sent event: "progress" while a job runs, "status" on transitions."""
+    data = {key: value for key, value in event.items() if key != "type"}
+    return f"event: {event['type']}\ndata: {json.dumps(data)}\n\n"
+
+
+async def iter_job_events(queue: asyncio.Queue, snapshot: list):
+    """Stream the current state of the jobs, then their events.
+
+    The stream ends once every watched job reached a terminal status.
+    """
+    try:
+        active = set()
+        for event in snapshot:
+            yield format_event(event)
+            if event["status"] not in TERMINAL_STATUSES:
+                active.add(event["job_id"])
+        while active:
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event["job_id"] not in active:
+                continue
+            yield format_event(event)
+            if event["status"] in TERMINAL_STATUSES:
+                active.discard(event["job_id"])
+    finally:
+        broadcaster.unsubscribe(queue, [event["job_id"] for event in snapshot])
+
+
+broadcaster = JobEventBroadcaster()
@@ -0,0 +1,653 @@
+import logging
+import multiprocessing
+import multiprocessing.sharedctypes
+import os
+import resource
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Event, Thread
+from typing import Dict, List, Optional
+
+from sqlalchemy import update
+from sqlmodel import func, select
+
+from api.config import MAX_WORKERS, MEMORY_BUDGET_BYTES
+from api.db import SessionLocal
+from api.events import broadcaster, job_event
+from api.models import ProcessJob
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for finished workers when nothing wakes the dispatcher
+POLL_INTERVAL = 0.5
+
+# Interpreter, libraries and buffers of a worker regardless of the data size
+WORKER_OVERHEAD_BYTES = 512 * 1024**2
+# Peak memory of writing each format, per byte of processed float32 data
+FORMAT_MEMORY_FACTORS = {
+    "msgpack": 12.0,  # Python lists of float objects
+    "columnar": 2.0,
+    "vertex": 3.0,
+    "arrow": 2.0,
+    "octree": 3.0,
+}
+# Recent completed jobs used to calibrate the model, and the calibration bounds
+CALIBRATION_JOBS = 20
+CALIBRATION_RANGE = (0.5, 4.0)
+# Stages a running job reports, stored by index in its shared state
+JOB_STAGES = ("starting", "converting", "writing")
+# Slots of the shared state array of a running job; STOP is raised by the
+# dispatcher to ask the worker to stop at its next chunk
+PROGRESS, STAGE, STOP = 0, 1, 2
+STATE_SIZE = 3
+# Values of the STOP slot: a preempted job keeps its checkpoint
+STOP_CANCELLED, STOP_PREEMPTED = 1, 2
+
+# Thread pool sizes read by polars, OpenMP/BLAS backends and numexpr at import
+THREAD_ENV_VARS = (
+    "POLARS_MAX_THREADS",
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+# Job priorities; lower values are claimed first and may preempt higher ones
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+PRIORITY_SPECULATIVE = 20
+
+# Starts after which a job interrupted by a restart is failed instead of re-queued
+MAX_ATTEMPTS = 3
+
+# Seconds a cancelled worker gets to stop at a chunk boundary before it is killed
+CANCEL_GRACE = 5.0
+
+
+def estimate_job_memory(payload: dict) -> int:
+    """Model the peak memory of a job from its file and options.
+
+    Conversion holds every selected variable of every point as float32
+    (FITS cubes always have x, y, z and value), plus a copy while
+    concatenating; the processed (downsampled) frame is then written
+    with a format-dependent overhead.
+    """
+    file = payload["file"]
+    options = payload["options"]
+    if file.get("type") == "fits":
+        variables = 4
+    else:
+        variables = sum(1 for var in file["variables"] if var.get("selected"))
+    raw_bytes = (file.get("total_points") or 0) * max(variables, 1) * 4
+    processed_bytes = raw_bytes * (file.get("downsampling") or 1.0)
+    factor = FORMAT_MEMORY_FACTORS.get(options.get("output_format"), 3.0)
+    if options.get("spatial_order", "none") != "none":
+        factor += 1.0
+    return int(WORKER_OVERHEAD_BYTES + 2 * raw_bytes + factor * processed_bytes)
+
+
+def thread_budget(concurrency: int, cpus: Optional[int] = None) -> int:
+    """CPU threads of one job when concurrency jobs share the machine."""
+    if cpus is None:
+        # CPUs this process may run on, which containers often restrict
+        cpus = (
+            len(os.sched_getaffinity(0))
+            if hasattr(os, "sched_getaffinity")
+            else os.cpu_count() or 1
+        )
+    return max(1, cpus // max(concurrency, 1))
+
+
+@contextmanager
+def _thread_env(threads: int):
+    """Environment a worker is spawned with, so its pools start at threads.
+
+    Spawned interpreters inherit the environment at start; the variables are
+    only read once, when each library is imported, so they are set around
+    Process.start() in the dispatcher and restored afterwards.
+    """
+    previous = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    os.environ.update({name: str(threads) for name in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _run_worker(job_id: int, state=None) -> None:
+    """Entry point of a worker process; state is the job's shared state array.
+
+    Nothing is returned to the parent: the worker writes the result straight
+    into its artifact file and records a descriptor of it (result path, report,
+    peak memory) on the job row, so point data never crosses the process
+    boundary.
+    """
+    from api.services.job import ProcessJobService
+
+    with SessionLocal() as session:
+        ProcessJobService(session).run_job(job_id, state)
+
+        # ru_maxrss is in KiB on Linux; one process per job makes it the job's peak
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        session.execute(
+            update(ProcessJob)
+            .where(ProcessJob.id == job_id)
+            .values(peak_memory=peak_memory)
+        )
+        session.commit()
+
+
+class JobExecutor:
+    """Runs queued processing jobs in a bounded pool of worker processes.
+
+    Purpose:
+    - Keep CPU- and memory-heavy conversions out of the API process and cap how
+      many run at once.
+
+    Responsibilities:
+    - Treat pending ProcessJob rows as a persistent queue ordered by
+      (priority, id), so queued jobs survive restarts; jobs a restart
+      interrupted are queued again and resume from their checkpoint.
+    - Preempt a running job of lower priority when the head of the queue
+      cannot start: it goes back to the queue and resumes from its checkpoint.
+    - Claim jobs (pending -> processing) and start one spawned process per job,
+      up to max_workers at a time.
+    - Admit a job only while the estimated peak memory of all running jobs fits
+      memory_budget; the queue head waits otherwise, so large jobs are not
+      starved by smaller ones behind them.
+    - Calibrate the memory model against the peak RSS recorded by finished jobs.
+    - Give each job a CPU thread budget (cores divided by the jobs expected to
+      run alongside it) and start its worker with polars, BLAS and
+      compression pools of that size, so concurrent jobs do not oversubscribe
+      the machine.
+    - Share a progress/stage array with each worker, so live progress is read
+      from memory rather than from the database.
+    - Exchange only job ids and descriptors with workers; results go straight
+      from the worker to disk and are served from there.
+    - Publish claims, progress changes and final statuses of jobs to the
+      event broadcaster.
+    - Track batch jobs: aggregate the progress of their file jobs and record
+      their final status once every file job finished.
+    - Mark jobs whose worker died without reporting as failed.
+    - Cancel jobs: queued ones are never claimed, running workers are
+      signalled through their shared state, stop at their next chunk and are killed if they do not exit within CANCEL_GRACE.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = MAX_WORKERS,
+        memory_budget: int = MEMORY_BUDGET_BYTES,
+        session_factory=SessionLocal,
+    ):
+        self.max_workers = max_workers
+        self.memory_budget = memory_budget
+        self.session_factory = session_factory
+        self.context = multiprocessing.get_context("spawn")
+        self.workers: Dict[int, multiprocessing.process.BaseProcess] = {}
+        # Calibrated memory estimate and thread budget of each running job
+        self.reserved: Dict[int, int] = {}
+        self.threads: Dict[int, int] = {}
+        # Live progress and stage of each running job, written by its worker
+        self.state: Dict[int, multiprocessing.sharedctypes.SynchronizedArray] = {}
+        # Last (progress, stage) published for each running job
+        self.published: Dict[int, tuple] = {}
+        # Running jobs asked to make room for a job of higher priority
+        self.preempting: set = set()
+        # Kill deadline of each running job that was cancelled
+        self.cancelled: Dict[int, float] = {}
+        self.wakeup = Event()
+        self.stopping = Event()
+        self.thread: Optional[Thread] = None
+
+    def start(self) -> None:
+        self.requeue_interrupted_jobs()
+        self.stopping.clear()
+        self.thread = Thread(target=self._dispatch_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def notify(self) -> None:
+        """Wake the dispatcher after a job was queued."""
+        self.wakeup.set()
+
+    def live_progress(self, job_id: int) -> Optional[float]:
+        """Progress of a job running in a worker of this executor."""
+        state = self.state.get(job_id)
+        return state[PROGRESS] if state is not None else None
+
+    def live_stage(self, job_id: int) -> Optional[str]:
+        """Stage of a job running in a worker of this executor."""
+        state = self.state.get(job_id)
+        return JOB_STAGES[int(state[STAGE])] if state is not None else None
+
+    def batch_state(self, session, batch: ProcessJob) -> dict:
+        """Status, progress and file jobs of a batch.
+
+        Progress is the average of the file jobs' progress weighted by their
+        point counts. The batch is pending until a file job starts and
+        processing until all have finished; it is then done, or error if a
+        file job failed, or cancelled.
+        """
+        entries = batch.payload["jobs"]
+        jobs = {
+            job.id: job
+            for job in session.exec(
+                select(ProcessJob).where(
+                    ProcessJob.id.in_([entry["job_id"] for entry in entries])
+                )
+            ).all()
+        }
+        files = []
+        for entry in entries:
+            job = jobs.get(entry["job_id"])
+            status = job.status if job else "error"
+            progress = job.progress if job else 1.0
+            if status == "processing":
+                progress = self.live_progress(job.id) or progress
+            files.append({**entry, "status": status, "progress": progress})
+
+        statuses = {file["status"] for file in files}
+        failed = sum(file["status"] == "error" for file in files)
+        if statuses == {"pending"}:
+            status = "pending"
+        elif statuses & {"pending", "processing"}:
+            status = "processing"
+        elif failed:
+            status = "error"
+        elif "cancelled" in statuses:
+            status = "cancelled"
+        else:
+            status = "done"
+
+        total = sum(file["weight"] for file in files)
+        return {
+            "status": status,
+            "progress": (
+                sum(file["weight"] * file["progress"] for file in files) / total
+                if total
+                else 1.0
+            ),
+            "error": f"{failed} of {len(files)} files failed" if failed else None,
+            "jobs": files,
+        }
+
+    def cancel_jobs(self, session, *criteria) -> List[int]:
+        """Cancel the queued and running jobs matching the criteria.
+
+        The update joins the caller's transaction; once it is committed, the
+        dispatcher raises the STOP flag of running workers, which stop at
+        their next chunk boundary.
+        """
+        job_ids = session.exec(
+            select(ProcessJob.id).where(
+                ProcessJob.status.in_(["pending", "processing"]), *criteria
+            )
+        ).all()
+        if job_ids:
+            session.execute(
+                update(ProcessJob)
+                .where(
+                    ProcessJob.id.in_(job_ids),
+                    ProcessJob.status.in_(["pending", "processing"]),
+                )
+                .values(
+                    status="cancelled",
+                    progress=1.0,
+                    error="Cancelled",
+                    updated_at=datetime.utcnow(),
+                )
+            )
+            self.notify()
+            for job_id in job_ids:
+                broadcaster.publish(
+                    job_event(job_id, "cancelled", 1.0, error="Cancelled")
+                )
+        return list(job_ids)
+
+    def requeue_interrupted_jobs(self) -> None:
+        """Queue again the jobs a previous server run left processing.
+
+        They keep their id, and so their place in the queue. A job that was
+        already started MAX_ATTEMPTS times is failed instead, so a job that
+        brings the server down cannot do so forever. Queued or interrupted
+        jobs without a payload (written by versions that ran jobs in threads)
+        cannot be run and are failed.
+        """
+        interrupted = (ProcessJob.kind == "file", ProcessJob.status == "processing")
+        with self.session_factory() as session:
+            unrunnable = [
+                job_id
+                for job_id, payload in session.exec(
+                    select(ProcessJob.id, ProcessJob.payload).where(
+                        ProcessJob.kind == "file",
+                        ProcessJob.status.in_(["pending", "processing"]),
+                    )
+                ).all()
+                if not payload
+            ]
+            if unrunnable:
+                session.execute(
+                    update(ProcessJob)
+                    .where(ProcessJob.id.in_(unrunnable))
+                    .values(
+                        status="error",
+                        progress=1.0,
+                        error="Interrupted before the job queue; process the file again",
+                        updated_at=datetime.utcnow(),
+                    )
+                )
+            session.execute(
+                update(ProcessJob)
+                .where(*interrupted, ProcessJob.attempts >= MAX_ATTEMPTS)
+                .values(
+                    status="error",
+                    progress=1.0,
+                    error="Interrupted by server restarts too many times",
+                    updated_at=datetime.utcnow(),
+                )
+            )
+            session.execute(
+                update(ProcessJob)
+                .where(*interrupted)
+                .values(status="pending", progress=0.0, updated_at=datetime.utcnow())
+            )
+            session.commit()
+
+    def calibration(self, session, output_format: str) -> float:
+        """Worst recent ratio of measured peak to modelled memory for a format."""
+        ratios = [
+            peak / estimate
+            for peak, estimate in session.exec(
+                select(ProcessJob.peak_memory, ProcessJob.memory_estimate)
+                .where(
+                    ProcessJob.output_format == output_format,
+                    ProcessJob.status == "done",
+                    ProcessJob.peak_memory.is_not(None),
+                    ProcessJob.memory_estimate > 0,
+                )
+                .order_by(ProcessJob.id.desc())
+                .limit(CALIBRATION_JOBS)
+            ).all()
+        ]
+        if not ratios:
+            return 1.0
+        low, high = CALIBRATION_RANGE
+        return min(max(max(ratios), low), high)
+
+    def next_job(self, session) -> Optional[ProcessJob]:
+        """Head of the queue: the oldest pending job of the highest priority.
+
+        Preempted jobs whose worker has not exited yet are skipped.
+        """
+        return session.exec(
+            select(ProcessJob)
+            .where(
+                ProcessJob.status == "pending",
+                ProcessJob.id.not_in(list(self.workers)),
+            )
+            .order_by(ProcessJob.priority, ProcessJob.id)
+        ).first()
+
+    def claim_next_job(self) -> Optional[int]:
+        """Move the head of the queue to processing and return its id.
+
+        Returns None when the queue is empty or the head does not fit the
+        memory left in the budget (a job always runs when nothing else does).
+        """
+        with self.session_factory() as session:
+            while True:
+                job = self.next_job(session)
+                if job is None:
+                    return None
+
+                estimate = estimate_job_memory(job.payload) if job.payload else 0
+                reserved = int(estimate * self.calibration(session, job.output_format))
+                if (
+                    self.reserved
+                    and sum(self.reserved.values()) + reserved > self.memory_budget
+                ):
+                    return None
+
+                # Jobs expected to share the CPUs: the running ones, this one
+                # and the queued ones that will fill the remaining workers
+                pending = session.exec(
+                    select(func.count()).where(ProcessJob.status == "pending")
+                ).one()
+                threads = thread_budget(
+                    min(self.max_workers, len(self.workers) + pending)
+                )
+
+                # Conditional update, in case another dispatcher claimed it first
+                claimed = session.execute(
+                    update(ProcessJob)
+                    .where(ProcessJob.id == job.id, ProcessJob.status == "pending")
+                    .values(
+                        status="processing",
+                        attempts=ProcessJob.attempts + 1,
+                        memory_estimate=estimate,
+                        threads=threads,
+                        updated_at=datetime.utcnow(),
+                    )
+                ).rowcount
+                session.commit()
+                if claimed:
+                    self.reserved[job.id] = reserved
+                    self.threads[job.id] = threads
+                    broadcaster.publish(
+                        job_event(job.id, "processing", 0.0, JOB_STAGES[0])
+                    )
+                    return job.id
+
+    def _dispatch_loop(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                self._reap_workers()
+                while len(self.workers) < self.max_workers:
+                    job_id = self.claim_next_job()
+                    if job_id is None:
+                        break
+                    state = self.context.Array("d", STATE_SIZE)
+                    process = self.context.Process(
+                        target=_run_worker, args=(job_id, state), daemon=True
+                    )
+                    with _thread_env(self.threads[job_id]):
+                        process.start()
+                    self.state[job_id] = state
+                    self.workers[job_id] = process
+                self._preempt_for_next_job()
+                self._publish_progress()
+                self._update_batches()
+            except Exception as e:
+                logger.error(f"Job dispatch failed: {e}")
+            self.wakeup.wait(POLL_INTERVAL)
+            self.wakeup.clear()
+
+    def _reap_workers(self) -> None:
+        self._stop_cancelled_workers()
+        for job_id, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.workers[job_id]
+            self.state.pop(job_id, None)
+            self.published.pop(job_id, None)
+            self.reserved.pop(job_id, None)
+            self.threads.pop(job_id, None)
+            self.cancelled.pop(job_id, None)
+            if process.exitcode != 0:
+                self._fail_job(job_id, f"Worker exited with code {process.exitcode}")
+            else:
+                # A worker that returned without recording an outcome must
+                # not leave its job processing forever
+                self._fail_job(
+                    job_id, "Worker exited without finishing the job", ("processing",)
+                )
+            self._publish_status(job_id)
+
+    def _preempt_for_next_job(self) -> None:
+        """Make room for a queue head that outranks a running job.
+
+        The running job of the lowest priority (the newest among equals)
+        that is still converting is put back in the queue; its worker stops
+        at the next chunk and keeps its checkpoint. The stage is checked and
+        the STOP flag raised under the state's lock, which the worker takes
+        to enter "writing", so a job that started writing is never preempted.
+        One job is preempted at a time, until its worker has exited.
+        """
+        if self.preempting & set(self.workers):
+            return
+        self.preempting.clear()
+        with self.session_factory() as session:
+            head = self.next_job(session)
+            if head is None or not self.workers:
+                return
+            head_id = head.id
+            running = session.exec(
+                select(ProcessJob.id, ProcessJob.priority).where(
+                    ProcessJob.id.in_(list(self.workers)),
+                    ProcessJob.status == "processing",
+                    ProcessJob.priority > head.priority,
+                )
+            ).all()
+            candidates = [
+                (priority, job_id)
+                for job_id, priority in running
+                if self.live_stage(job_id) == "converting"
+            ]
+            if not candidates:
+                return
+            _, job_id = max(candidates)
+            state = self.state[job_id]
+            with state.get_lock():
+                if JOB_STAGES[int(state[STAGE])] != "converting":
+                    return
+                state[STOP] = STOP_PREEMPTED
+            preempted = session.execute(
+                update(ProcessJob)
+                .where(ProcessJob.id == job_id, ProcessJob.status == "processing")
+                .values(
+                    status="pending",
+                    progress=0.0,
+                    # Preemption does not count as a failed attempt
+                    attempts=ProcessJob.attempts - 1,
+                    updated_at=datetime.utcnow(),
+                )
+            ).rowcount
+            session.commit()
+        if preempted:
+            logger.info(f"Preempting job {job_id} for job {head_id}")
+            self.preempting.add(job_id)
+
+    def _publish_progress(self) -> None:
+        """Publish the running jobs whose progress or stage changed."""
+        for job_id, state in list(self.state.items()):
+            current = (state[PROGRESS], int(state[STAGE]))
+            if self.published.get(job_id) == current:
+                continue
+            self.published[job_id] = current
+            broadcaster.publish(
+                job_event(
+                    job_id,
+                    "processing",
+                    current[0],
+                    JOB_STAGES[current[1]],
+                    type="progress",
+                )
+            )
+
+    def _update_batches(self) -> None:
+        """Publish the progress of running batches and record finished ones."""
+        with self.session_factory() as session:
+            batches = session.exec(
+                select(ProcessJob).where(
+                    ProcessJob.kind == "batch", ProcessJob.status == "processing"
+                )
+            ).all()
+            for batch in batches:
+                state = self.batch_state(session, batch)
+                if state["status"] in ("pending", "processing"):
+                    current = (state["progress"], None)
+                    if self.published.get(batch.id) != current:
+                        self.published[batch.id] = current
+                        broadcaster.publish(
+                            job_event(
+                                batch.id,
+                                "processing",
+                                state["progress"],
+                                type="progress",
+                            )
+                        )
+                    continue
+                # Conditional update, in case the batch was cancelled meanwhile
+                session.execute(
+                    update(ProcessJob)
+                    .where(ProcessJob.id == batch.id, ProcessJob.status == "processing")
+                    .values(
+                        status=state["status"],
+                        progress=1.0,
+                        error=state["error"],
+                        updated_at=datetime.utcnow(),
+                    )
+                )
+                session.commit()
+                self.published.pop(batch.id, None)
+                self._publish_status(batch.id)
+
+    def _publish_status(self, job_id: int) -> None:
+        """Publish the status recorded in a job's row."""
+        if not broadcaster.watching(job_id):
+            return
+        with self.session_factory() as session:
+            job = session.get(ProcessJob, job_id)
+            if job:
+                broadcaster.publish(
+                    job_event(job_id, job.status, job.progress, error=job.error)
+                )
+
+    def _stop_cancelled_workers(self) -> None:
+        """Signal cancelled workers to stop; kill those that did not within the
+        grace period."""
+        if not self.workers:
+            return
+        with self.session_factory() as session:
+            cancelled = session.exec(
+                select(ProcessJob.id).where(
+                    ProcessJob.id.in_(list(self.workers)),
+                    ProcessJob.status == "cancelled",
+                )
+            ).all()
+        now = time.monotonic()
+        for job_id in cancelled:
+            state = self.state.get(job_id)
+            if state is not None:
+                state[STOP] = STOP_CANCELLED
+            deadline = self.cancelled.setdefault(job_id, now + CANCEL_GRACE)
+            process = self.workers[job_id]
+            if now >= deadline and process.is_alive():
+                logger.warning(f"Killing cancelled job {job_id}")
+                process.kill()
+
+    def _fail_job(
+        self, job_id: int, error: str, statuses=("pending", "processing")
+    ) -> None:
+        with self.session_factory() as session:
+            job = session.get(ProcessJob, job_id)
+            if job and job.status in statuses:
+                job.status = "error"
+                job.progress = 1.0
+                job.error = error
+                session.commit()
+
+
+executor = JobExecutor()
@@ -1,19 +1,28 @@
+import asyncio
 from contextlib import asynccontextmanager
+from threading import Thread
 
 import uvicorn
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
 from api.db import create_db_and_tables
+from api.events import broadcaster
 from api.exceptions import APIException
+from api.executor import executor
 from api.routes.jobs import router as jobs_router
 from api.routes.projects import router as projects_router
+from api.services.artifact import sweep_artifacts
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_db_and_tables()
+    broadcaster.bind(asyncio.get_running_loop())
+    Thread(target=sweep_artifacts, daemon=True).start()
+    executor.start()
     yield
+    executor.stop()
 
 
 app = FastAPI(lifespan=lifespan, debug=True)
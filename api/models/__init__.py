@@ -1,4 +1,5 @@
 from .db import (
+    Artifact,
     File,
     FileProjectLink,
     HistogramBin,
@@ -11,6 +12,7 @@ from .db import (
 )
 from .file import FileCreate, FileRead, FileUpdate
 from .histo import HistoBase
+from .processjob import ProcessOptions
 from .project import (
     ProjectCreate,
     ProjectDuplicate,
@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import List, Optional
 
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import JSON, Column, Index, UniqueConstraint, text
 from sqlmodel import Field, Relationship, SQLModel
 
 from .file import FileBase
@@ -57,10 +57,22 @@ class FileProjectLink(SQLModel, table=True):
     processed: bool = False
     downsampling: float = 1.0
     processed_path: Optional[str] = None
+    artifact_key: Optional[str] = Field(default=None, index=True)
+    output_format: str = "msgpack"
     order: Optional[int] = -1
     noise: Optional[float] = 0
 
 
+class Artifact(SQLModel, table=True):
+    key: str = Field(primary_key=True)
+    path: str
+    size: int = 0
+    output_format: str = "msgpack"
+    report: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    last_accessed: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+
 class Variable(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     file_id: int = Field(foreign_key="file.id")
@@ -96,13 +108,40 @@ class Project(ProjectBase, table=True):
 
 
 class ProcessJob(SQLModel, table=True):
+    # At most one queued or running job per project file and configuration
+    __table_args__ = (
+        Index(
+            "ix_processjob_active_dedup_key",
+            "dedup_key",
+            unique=True,
+            sqlite_where=text("status IN ('pending', 'processing')"),
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     project_id: Optional[int] = Field(default=None, foreign_key="project.id")
     file_id: Optional[int] = Field(default=None, foreign_key="file.id")
-    status: str = "pending"  # "pending", "processing", "done", "error"
+    # A batch job groups the file jobs of a project and never runs itself
+    kind: str = "file"  # "file", "batch"
+    status: str = "pending"  # "pending", "processing", "done", "error", "cancelled"
+    # Queue order is (priority, id); lower values run first
+    priority: int = 0
+    dedup_key: Optional[str] = None
     progress: float = 0.0
     result_path: Optional[str] = Field(default=None, nullable=True)
+    output_format: str = "msgpack"
     error: Optional[str] = Field(default=None, nullable=True)
+    report: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    # File snapshot, options and artifact key a worker needs to run the job;
+    # for a batch, its file jobs ({"file_id", "job_id", "weight"}, largest first)
+    payload: Optional[dict] = Field(default=None, sa_column=Column(JSON))
+    # Modelled and measured peak memory of the worker, in bytes
+    memory_estimate: Optional[int] = None
+    peak_memory: Optional[int] = None
+    # CPU threads the worker's polars, BLAS and compression pools were sized to
+    threads: Optional[int] = None
+    # Times a worker was started for the job
+    attempts: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
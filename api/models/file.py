@@ -23,6 +23,7 @@ class FileRead(FileBase):
     processed: Optional[bool] = False
     downsampling: Optional[float] = 1.0
     processed_path: Optional[str] = None
+    output_format: Optional[str] = "msgpack"
     order: Optional[int] = -1
     variables: List[VariableRead] = []
 
@@ -0,0 +1,50 @@
+from typing import Literal, Optional
+
+from pydantic import model_validator
+from sqlmodel import Field, SQLModel
+
+
+class ProcessOptions(SQLModel):
+    """Output options for a processing request.
+
+    "msgpack" is the legacy row-wise layout; "columnar" stores one float32
+    buffer per column; "vertex" stores an interleaved GPU vertex buffer;
+    "arrow" stores an Arrow IPC file of "batch_size"-row record batches;
+    "octree" stores a level-of-detail octree of separately served tiles.
+    "compression" stores the artifact zstd or lz4 encoded (Arrow files
+    compress their buffers instead). "quantization" stores columnar data
+    as float16 or as uint16/uint8 normalized to each column's min/max.
+    "spatial_order" sorts rows along the Morton curve of the axis variables.
+    """
+
+    output_format: Literal["msgpack", "columnar", "vertex", "arrow", "octree"] = (
+        "msgpack"
+    )
+    compression: Literal["none", "zstd", "lz4"] = "none"
+    quantization: Literal["none", "float16", "uint16", "uint8"] = "none"
+    batch_size: Optional[int] = Field(default=None, gt=0)
+    spatial_order: Literal["none", "morton"] = "none"
+
+    @model_validator(mode="after")
+    def validate_quantization(self):
+        if self.quantization != "none" and self.output_format != "columnar":
+            raise ValueError("quantization requires the columnar output format")
+        return self
+
+    @model_validator(mode="after")
+    def validate_compression(self):
+        if self.compression != "none" and self.output_format == "octree":
+            raise ValueError("octree tiles are served uncompressed")
+        return self
+
+    @model_validator(mode="after")
+    def validate_spatial_order(self):
+        if self.spatial_order != "none" and self.output_format == "octree":
+            raise ValueError("octree output is already in Morton order")
+        return self
+
+    @model_validator(mode="after")
+    def validate_batch_size(self):
+        if self.batch_size is not None and self.output_format != "arrow":
+            raise ValueError("batch_size requires the arrow output format")
+        return self
@@ -0,0 +1,177 @@
+import hashlib
+import os
+from typing import List, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+from api.error_handlers import ArtifactProjectionError
+from src.compression import READ_SIZE, encoding_for_path, iter_decompressed
+from src.octree import read_octree_index
+from src.readers import arrow_projection, columnar_projection
+
+MEDIA_TYPES = {
+    "msgpack": "application/x-msgpack",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+
+
+class ArtifactFileResponse(FileResponse):
+    chunk_size = 1024 * 1024
+
+
+def artifact_etag(path: str) -> str:
+    stat = os.stat(path)
+    etag_base = f"{stat.st_mtime_ns}-{stat.st_size}"
+    return f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"'
+
+
+def accepted_encodings(request: Request) -> set:
+    """Content codings the client accepts (q=0 entries excluded)."""
+    accepted = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if coding and not any(p.replace(" ", "") in ("q=0", "q=0.0") for p in params):
+            accepted.add(coding.lower())
+    return accepted
+
+
+def artifact_response(
+    request: Request,
+    path: str,
+    columns: Optional[List[str]] = None,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    output_format: str = "msgpack",
+) -> Response:
+    """Stream an artifact from disk.
+
+    FileResponse sends Content-Length, ETag and Last-Modified, answers Range and
+    If-Range requests with partial content and uses the server's sendfile
+    (pathsend) extension when available, so memory use does not grow with the
+    artifact size.
+
+    Compressed artifacts are sent as stored with a Content-Encoding header when
+    the client accepts that coding, and decompressed on the fly otherwise.
+
+    When a column subset or a row range is requested, only the matching
+    slices of a columnar or Arrow artifact are read and sent in the same
+    format.
+    """
+    media_type = MEDIA_TYPES.get(output_format, "application/octet-stream")
+    try:
+        etag = artifact_etag(path)
+    except FileNotFoundError:
+        return Response(
+            content="Processed file not found", status_code=404, media_type="text/plain"
+        )
+
+    if columns or offset or limit is not None:
+        return projected_response(path, columns, offset, limit, output_format)
+
+    encoding = encoding_for_path(path)
+    headers = {"etag": etag, "accept-ranges": "bytes"}
+    if encoding:
+        headers["vary"] = "Accept-Encoding"
+        accepted = accepted_encodings(request)
+        if encoding not in accepted and "*" not in accepted:
+            # Decoded representation: no Range support, distinct validator
+            headers = {"etag": f'{etag[:-1]}-identity"', "vary": "Accept-Encoding"}
+            if request.headers.get("if-none-match") == headers["etag"]:
+                return Response(status_code=304, headers=headers)
+            return StreamingResponse(
+                iter_decompressed(path, encoding),
+                media_type=media_type,
+                headers=headers,
+            )
+        headers["content-encoding"] = encoding
+
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return ArtifactFileResponse(path, media_type=media_type, headers=headers)
+
+
+def projected_response(
+    path: str,
+    columns: Optional[List[str]],
+    offset: int,
+    limit: Optional[int],
+    output_format: str,
+) -> Response:
+    try:
+        if output_format == "arrow":
+            size, content = arrow_projection(path, columns, offset, limit)
+        else:
+            size, content = columnar_projection(path, columns, offset, limit)
+    except ValueError as e:
+        raise ArtifactProjectionError(str(e))
+    return StreamingResponse(
+        content,
+        media_type=(
+            MEDIA_TYPES["arrow"]
+            if output_format == "arrow"
+            else "application/octet-stream"
+        ),
+        headers={"content-length": str(size)},
+    )
+
+
+def file_range_response(path: str, offset: int, nbytes: int) -> Response:
+    """Stream a byte range of an uncompressed file.
+
+    The file is opened before responding, so a job finishing (and removing
+    its chunks) does not cut the transfer short.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return Response(content="Not found", status_code=404, media_type="text/plain")
+
+    def iter_range():
+        with f:
+            f.seek(offset)
+            remaining = nbytes
+            while remaining > 0 and (data := f.read(min(READ_SIZE, remaining))):
+                remaining -= len(data)
+                yield data
+
+    return StreamingResponse(
+        iter_range(),
+        media_type="application/octet-stream",
+        headers={"content-length": str(nbytes)},
+    )
+
+
+def _octree_index(path: str, output_format: str):
+    if output_format != "octree":
+        return Response(
+            content="Not an octree artifact", status_code=400, media_type="text/plain"
+        )
+    try:
+        return read_octree_index(path)
+    except FileNotFoundError:
+        return Response(
+            content="Processed file not found", status_code=404, media_type="text/plain"
+        )
+
+
+def octree_index_response(path: str, output_format: str):
+    """The node hierarchy of an octree artifact."""
+    index = _octree_index(path, output_format)
+    if isinstance(index, Response):
+        return index
+    return {key: value for key, value in index.items() if key != "by_id"}
+
+
+def tile_response(path: str, output_format: str, node_id: str) -> Response:
+    """One octree node as a columnar artifact."""
+    index = _octree_index(path, output_format)
+    if isinstance(index, Response):
+        return index
+    node = index["by_id"].get(node_id)
+    if not node:
+        return Response(
+            content="Tile not found", status_code=404, media_type="text/plain"
+        )
+    return file_range_response(path, node["offset"], node["nbytes"])
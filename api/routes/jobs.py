@@ -1,28 +1,135 @@
-from fastapi import APIRouter, Response
+from typing import List, Optional
+
+from fastapi import APIRouter, Query, Request, Response
+from fastapi.responses import StreamingResponse
 
 from api.deps import ProcessJobServiceDep
+from api.responses import (
+    artifact_response,
+    file_range_response,
+    octree_index_response,
+    tile_response,
+)
 
 router = APIRouter(prefix="/jobs", tags=["jobs"])
 
 
+@router.get("/events", response_class=StreamingResponse)
+async def process_events(
+    *, job_id: List[int] = Query(...), service: ProcessJobServiceDep
+):
+    """Stream progress and status events of one or more jobs (Server-Sent Events)"""
+    events = service.stream_job_events(list(dict.fromkeys(job_id)))
+
+    if events is None:
+        return Response(
+            content="Job not found", status_code=404, media_type="text/plain"
+        )
+
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get("/{job_id}/progress")
 def process_progress(*, job_id: int, service: ProcessJobServiceDep):
     """Get processing progress"""
     return service.get_job_progress(job_id)
 
 
+@router.delete("/{job_id}")
+def cancel_process(*, job_id: int, service: ProcessJobServiceDep):
+    """Cancel a queued or running job"""
+    job = service.cancel_job(job_id)
+
+    if not job:
+        return Response(
+            content="Job not found", status_code=404, media_type="text/plain"
+        )
+    if job.status != "cancelled":
+        return Response(
+            content=f"Job already {job.status}",
+            status_code=409,
+            media_type="text/plain",
+        )
+
+    return service.get_job_progress(job_id)
+
+
 @router.get("/{job_id}/result", response_class=Response)
-def process_result(*, job_id: int, service: ProcessJobServiceDep):
-    """Get processing result"""
-    result_path = service.get_job_result_path(job_id)
+def process_result(
+    *,
+    job_id: int,
+    request: Request,
+    columns: Optional[List[str]] = Query(None),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=0),
+    service: ProcessJobServiceDep,
+):
+    """Get processing result, optionally projected onto columns and a row range"""
+    job = service.get_job_result(job_id)
+
+    if not job:
+        return Response(
+            content="Job not found or not completed",
+            status_code=404,
+            media_type="text/plain",
+        )
+
+    return artifact_response(
+        request, job.result_path, columns, offset, limit, job.output_format
+    )
+
+
+@router.get("/{job_id}/chunks")
+def process_chunks(*, job_id: int, service: ProcessJobServiceDep):
+    """List the partial results published so far by a running job"""
+    chunks = service.get_job_chunks(job_id)
+    if chunks is None:
+        return {"error": "Job not found"}
+    return chunks
+
+
+@router.get("/{job_id}/chunks/{chunk_index}", response_class=Response)
+def process_chunk(*, job_id: int, chunk_index: int, service: ProcessJobServiceDep):
+    """Get one partial result of a running job"""
+    chunk = service.get_job_chunk(job_id, chunk_index)
+
+    if not chunk:
+        return Response(
+            content="Chunk not found", status_code=404, media_type="text/plain"
+        )
+
+    return file_range_response(chunk["path"], chunk["offset"], chunk["nbytes"])
+
+
+@router.get("/{job_id}/tiles")
+def process_tiles(*, job_id: int, service: ProcessJobServiceDep):
+    """Get the octree hierarchy of a processing result"""
+    job = service.get_job_result(job_id)
+
+    if not job:
+        return Response(
+            content="Job not found or not completed",
+            status_code=404,
+            media_type="text/plain",
+        )
+
+    return octree_index_response(job.result_path, job.output_format)
+
+
+@router.get("/{job_id}/tiles/{node_id}", response_class=Response)
+def process_tile(*, job_id: int, node_id: str, service: ProcessJobServiceDep):
+    """Get one octree tile of a processing result"""
+    job = service.get_job_result(job_id)
 
-    if not result_path:
+    if not job:
         return Response(
             content="Job not found or not completed",
             status_code=404,
             media_type="text/plain",
         )
 
-    with open(result_path, "rb") as f:
-        data = f.read()
-    return Response(content=data, media_type="application/octet-stream")
+    return tile_response(job.result_path, job.output_format, node_id)
@@ -1,11 +1,12 @@
-from typing import List
+from typing import List, Optional
 
-from fastapi import APIRouter, Response
+from fastapi import APIRouter, Query, Request, Response
 
 from api.deps import FileServiceDep, ProcessJobServiceDep, ProjectServiceDep
 from api.models import (
     FileRead,
     FileUpdate,
+    ProcessOptions,
     ProjectCreate,
     ProjectDuplicate,
     ProjectFilesUpdate,
@@ -14,6 +15,7 @@ from api.models import (
     RenderRead,
     RenderUpdate,
 )
+from api.responses import artifact_response, octree_index_response, tile_response
 
 router = APIRouter(prefix="/projects", tags=["projects"])
 
@@ -60,6 +62,30 @@ def duplicate_project(
     return service.duplicate_project(project_id=project_id, project=project)
 
 
+@router.post("/{project_id}/process")
+def process_project(
+    *,
+    project_id: int,
+    options: Optional[ProcessOptions] = None,
+    pjservice: ProcessJobServiceDep,
+    fservice: FileServiceDep,
+):
+    """Start processing every file of a project as one batch job"""
+
+    batch = pjservice.start_project_processing(project_id=project_id, options=options)
+
+    for entry in batch.payload["jobs"]:
+        fservice.create_render(project_id=project_id, file_id=entry["file_id"])
+
+    return {
+        "job_id": batch.id,
+        "jobs": [
+            {"file_id": entry["file_id"], "job_id": entry["job_id"]}
+            for entry in batch.payload["jobs"]
+        ],
+    }
+
+
 @router.put("/{project_id}/files", response_model=ProjectRead)
 def replace_project_files(
     *, project_id: int, files_update: ProjectFilesUpdate, service: ProjectServiceDep
@@ -87,8 +113,17 @@ def update_file(
 
 
 @router.get("/{project_id}/file/{file_id}/process")
-def processed_file(*, project_id: int, file_id: int, service: FileServiceDep):
-    """Get processed file"""
+def processed_file(
+    *,
+    project_id: int,
+    file_id: int,
+    request: Request,
+    columns: Optional[List[str]] = Query(None),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=0),
+    service: FileServiceDep,
+):
+    """Get processed file, optionally projected onto columns and a row range"""
 
     file = service.get_cached_file(project_id=project_id, file_id=file_id)
     if not file:
@@ -102,9 +137,49 @@ def processed_file(*, project_id: int, file_id: int, service: FileServiceDep):
             media_type="text/plain",
         )
 
-    with open(file.processed_path, "rb") as f:
-        data = f.read()
-    return Response(content=data, media_type="application/octet-stream")
+    return artifact_response(
+        request, file.processed_path, columns, offset, limit, file.output_format
+    )
+
+
+@router.get("/{project_id}/file/{file_id}/tiles")
+def processed_file_tiles(*, project_id: int, file_id: int, service: FileServiceDep):
+    """Get the octree hierarchy of a processed file"""
+
+    file = service.get_cached_file(project_id=project_id, file_id=file_id)
+    if not file:
+        return Response(
+            content="File not found", status_code=404, media_type="text/plain"
+        )
+    if not file.processed:
+        return Response(
+            content="File not processed yet",
+            status_code=400,
+            media_type="text/plain",
+        )
+
+    return octree_index_response(file.processed_path, file.output_format)
+
+
+@router.get("/{project_id}/file/{file_id}/tiles/{node_id}", response_class=Response)
+def processed_file_tile(
+    *, project_id: int, file_id: int, node_id: str, service: FileServiceDep
+):
+    """Get one octree tile of a processed file"""
+
+    file = service.get_cached_file(project_id=project_id, file_id=file_id)
+    if not file:
+        return Response(
+            content="File not found", status_code=404, media_type="text/plain"
+        )
+    if not file.processed:
+        return Response(
+            content="File not processed yet",
+            status_code=400,
+            media_type="text/plain",
+        )
+
+    return tile_response(file.processed_path, file.output_format, node_id)
 
 
 @router.post("/{project_id}/file/{file_id}/process")
@@ -112,12 +187,15 @@ def process_file(
     *,
     project_id: int,
     file_id: int,
+    options: Optional[ProcessOptions] = None,
     pjservice: ProcessJobServiceDep,
     fservice: FileServiceDep,
 ):
     """Start processing a file"""
 
-    job_id = pjservice.start_file_processing(project_id=project_id, file_id=file_id)
+    job_id = pjservice.start_file_processing(
+        project_id=project_id, file_id=file_id, options=options
+    )
 
     fservice.create_render(project_id=project_id, file_id=file_id)
 
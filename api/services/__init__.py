@@ -1,3 +1,4 @@
+from .artifact import ArtifactService
 from .file import FileService
 from .job import ProcessJobService
 from .project import ProjectService
@@ -0,0 +1,345 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import func, update
+from sqlmodel import Session, select
+
+from api.config import (
+    ARTIFACTS_DIR,
+    CACHE_BUDGET_BYTES,
+    DATA_DIR,
+    DOWNSAMPLING_SEED,
+    PARTIAL_DIR,
+    RAW_CACHE_DIR,
+)
+from api.db import SessionLocal
+from api.models import (
+    Artifact,
+    File,
+    FileProjectLink,
+    FileRead,
+    ProcessJob,
+    ProcessOptions,
+)
+from src.cache import file_fingerprint
+from src.compression import EXTENSIONS
+from src.processors import selection_thresholds
+
+logger = logging.getLogger(__name__)
+
+LEGACY_ARTIFACT_PATTERN = re.compile(r"project_\d+_file_\d+_processed\.msgpack$")
+
+
+class ArtifactService:
+    """Service for content-addressed processed artifacts.
+
+    Purpose:
+    - Let projects that process the same file with identical settings share one artifact.
+
+    Responsibilities:
+    - Derive artifact keys from the file fingerprint and the effective processing settings.
+    - Register artifacts and link/unlink them to FileProjectLink rows.
+    - Reference-count artifacts through FileProjectLink.artifact_key and delete unused ones.
+    - Keep the artifacts and the raw cache within CACHE_BUDGET_BYTES by evicting
+      least-recently-used entries, and sweep orphaned files left by deleted projects or failed jobs
+      (including partial results of jobs that stopped running).
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    @staticmethod
+    def artifact_key(file_data: FileRead, options: ProcessOptions) -> str:
+        """Hash everything that determines the content of a processed artifact."""
+        payload = {
+            "fingerprint": file_fingerprint(file_data.path),
+            "variables": [
+                [
+                    var.var_name,
+                    # Thresholds that filter nothing all produce the same output
+                    selection_thresholds(var),
+                    var.x_axis,
+                    var.y_axis,
+                    var.z_axis,
+                ]
+                for var in file_data.variables
+                if var.selected
+            ],
+            "downsampling": file_data.downsampling,
+            "seed": DOWNSAMPLING_SEED,
+            # Artifacts sampled per chunk with a fixed sample size may be empty
+            "sampling": "bernoulli",
+            "options": options.model_dump(),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def artifact_path(key: str, options: ProcessOptions) -> str:
+        os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+        # Arrow files compress their buffers internally and stay memory-mappable
+        extension = (
+            ""
+            if options.output_format == "arrow"
+            else EXTENSIONS.get(options.compression, "")
+        )
+        return os.path.join(ARTIFACTS_DIR, f"{key}.{options.output_format}{extension}")
+
+    def get_artifact(self, key: str) -> Optional[Artifact]:
+        """Return the artifact for a key if it is registered and still on disk."""
+        artifact = self.session.get(Artifact, key)
+        if artifact and os.path.exists(artifact.path):
+            return artifact
+        return None
+
+    def register_artifact(
+        self, key: str, path: str, output_format: str, report: Optional[dict] = None
+    ) -> Artifact:
+        artifact = self.session.get(Artifact, key) or Artifact(key=key, path=path)
+        artifact.path = path
+        artifact.size = os.path.getsize(path)
+        artifact.output_format = output_format
+        artifact.report = report or None
+        self.session.add(artifact)
+        return artifact
+
+    def link_artifact(
+        self, project_id: int, file_id: int, artifact: Artifact
+    ) -> Optional[FileProjectLink]:
+        """Point a project file at an artifact, releasing the previous one.
+
+        The link row is write-locked before its previous artifact is read, so
+        workers finishing jobs for the same project file one after the other
+        each release the artifact they actually replace.
+        """
+        where = (
+            FileProjectLink.project_id == project_id,
+            FileProjectLink.file_id == file_id,
+        )
+        self.session.execute(
+            update(FileProjectLink)
+            .where(*where)
+            .values(artifact_key=FileProjectLink.artifact_key)
+        )
+        link = self.session.exec(
+            select(FileProjectLink)
+            .where(*where)
+            .execution_options(populate_existing=True)
+        ).first()
+        if not link:
+            return None
+        if link.artifact_key != artifact.key:
+            self.release_artifact(link)
+        link.processed = True
+        link.processed_path = artifact.path
+        link.artifact_key = artifact.key
+        link.output_format = artifact.output_format
+        self.session.add(link)
+        return link
+
+    def reference_count(self, key: str) -> int:
+        return self.session.exec(
+            select(func.count()).where(FileProjectLink.artifact_key == key)
+        ).one()
+
+    def release_artifact(self, link: FileProjectLink) -> None:
+        """Unlink a project file from its artifact and drop the artifact if unused."""
+        key, path = link.artifact_key, link.processed_path
+        link.processed = False
+        link.processed_path = None
+        link.artifact_key = None
+        self.session.add(link)
+
+        if key is None:
+            # Pre content-addressing artifacts belong to a single link
+            if path and os.path.exists(path):
+                os.remove(path)
+            return
+
+        self.session.flush()
+        if self.reference_count(key) == 0:
+            self.delete_artifact(key)
+
+    def delete_artifact(self, key: str) -> None:
+        artifact = self.session.get(Artifact, key)
+        if not artifact:
+            return
+        if os.path.exists(artifact.path):
+            os.remove(artifact.path)
+        self.session.delete(artifact)
+
+    def touch_artifact(self, path: str) -> None:
+        """Record an access so the artifact moves to the back of the eviction order."""
+        artifact = self.session.exec(
+            select(Artifact).where(Artifact.path == path)
+        ).first()
+        if artifact:
+            artifact.last_accessed = datetime.utcnow()
+            self.session.add(artifact)
+            self.session.commit()
+
+    def evict_artifact(self, key: str) -> None:
+        """Delete an artifact and mark every project file using it as unprocessed."""
+        links = self.session.exec(
+            select(FileProjectLink).where(FileProjectLink.artifact_key == key)
+        ).all()
+        for link in links:
+            link.processed = False
+            link.processed_path = None
+            link.artifact_key = None
+            self.session.add(link)
+        self.delete_artifact(key)
+
+    def enforce_budget(
+        self, budget: int = CACHE_BUDGET_BYTES, keep: Optional[str] = None
+    ) -> None:
+        """Evict least-recently-used cache entries until the total size fits the budget.
+
+        Artifacts and raw cache entries (one directory per source file) share
+        the budget and one eviction order. Raw cache entries of files with a
+        queued or running job are not evicted.
+        """
+        total = self.session.exec(
+            select(func.coalesce(func.sum(Artifact.size), 0))
+        ).one()
+        raw_entries = _raw_cache_entries()
+        total += sum(size for _, size, _ in raw_entries)
+        if total <= budget:
+            return
+
+        in_use = {
+            file_fingerprint(payload["file"]["path"])
+            for payload in self.session.exec(
+                select(ProcessJob.payload).where(
+                    ProcessJob.kind == "file",
+                    ProcessJob.status.in_(["pending", "processing"]),
+                )
+            ).all()
+            if payload
+        }
+        entries = [
+            (
+                artifact.last_accessed.replace(tzinfo=timezone.utc).timestamp(),
+                artifact.size,
+                artifact,
+            )
+            for artifact in self.session.exec(select(Artifact)).all()
+            if artifact.key != keep
+        ] + [entry for entry in raw_entries if os.path.basename(entry[2]) not in in_use]
+        for _, size, entry in sorted(entries, key=lambda entry: entry[0]):
+            if total <= budget:
+                break
+            total -= size
+            if isinstance(entry, Artifact):
+                logger.info(f"Evicting artifact {entry.key} ({size} bytes)")
+                self.evict_artifact(entry.key)
+            else:
+                logger.info(f"Evicting raw cache entry {entry} ({size} bytes)")
+                shutil.rmtree(entry, ignore_errors=True)
+
+    def sweep_orphans(self) -> None:
+        """Remove files and rows that no artifact or project file refers to anymore."""
+        started = time.time()
+
+        # Registered artifacts whose file has disappeared
+        for artifact in self.session.exec(select(Artifact)).all():
+            if not os.path.exists(artifact.path):
+                self.evict_artifact(artifact.key)
+        self.session.flush()
+
+        # Unregistered files in the artifact directory (e.g. partial writes)
+        if os.path.isdir(ARTIFACTS_DIR):
+            tracked = {
+                os.path.normpath(path)
+                for path in self.session.exec(select(Artifact.path)).all()
+            }
+            for name in os.listdir(ARTIFACTS_DIR):
+                path = os.path.join(ARTIFACTS_DIR, name)
+                if os.path.normpath(path) not in tracked:
+                    _remove_if_stale(path, started)
+
+        # Per-project artifacts written before content addressing
+        linked = {
+            os.path.normpath(path)
+            for path in self.session.exec(
+                select(FileProjectLink.processed_path).where(
+                    FileProjectLink.processed_path.is_not(None)
+                )
+            ).all()
+        }
+        for name in os.listdir(DATA_DIR):
+            path = os.path.join(DATA_DIR, name)
+            if (
+                LEGACY_ARTIFACT_PATTERN.match(name)
+                and os.path.normpath(path) not in linked
+            ):
+                _remove_if_stale(path, started)
+
+        # Raw cache entries of files that changed or are no longer known
+        if os.path.isdir(RAW_CACHE_DIR):
+            fingerprints = {
+                file_fingerprint(path)
+                for path in self.session.exec(select(File.path)).all()
+            }
+            for name in os.listdir(RAW_CACHE_DIR):
+                if name not in fingerprints:
+                    _remove_if_stale(os.path.join(RAW_CACHE_DIR, name), started)
+
+        # Partial results of jobs that are no longer running
+        if os.path.isdir(PARTIAL_DIR):
+            running = {
+                str(job_id)
+                for job_id in self.session.exec(
+                    select(ProcessJob.id).where(
+                        ProcessJob.status.in_(["pending", "processing"])
+                    )
+                ).all()
+            }
+            for name in os.listdir(PARTIAL_DIR):
+                if name not in running:
+                    _remove_if_stale(os.path.join(PARTIAL_DIR, name), started)
+
+        self.enforce_budget()
+
+
+def _raw_cache_entries() -> list:
+    """(last use, size, path) of each source file's raw cache directory."""
+    if not os.path.isdir(RAW_CACHE_DIR):
+        return []
+    entries = []
+    for name in os.listdir(RAW_CACHE_DIR):
+        path = os.path.join(RAW_CACHE_DIR, name)
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            # Removed meanwhile
+            continue
+    return entries
+
+
+def _remove_if_stale(path: str, started: float) -> None:
+    """Remove a file or directory unless it was written after the sweep started."""
+    if os.path.getmtime(path) >= started:
+        return
+    logger.info(f"Removing orphaned cache entry {path}")
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+
+
+def sweep_artifacts() -> None:
+    """Background entry point for the startup orphan sweep."""
+    with SessionLocal() as session:
+        try:
+            ArtifactService(session).sweep_orphans()
+            session.commit()
+        except Exception as e:
+            logger.error(f"Artifact sweep failed: {e}")
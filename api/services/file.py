@@ -1,4 +1,3 @@
-import os
 from datetime import datetime
 from typing import Dict, List
 
@@ -6,6 +5,7 @@ from sqlalchemy.orm import selectinload
 from sqlmodel import Session, select
 
 from api.error_handlers import FileNotFoundError, ProjectNotFoundError
+from api.executor import PRIORITY_SPECULATIVE, executor
 from api.models import (
     File,
     FileCreate,
@@ -13,6 +13,7 @@ from api.models import (
     FileRead,
     FileUpdate,
     HistogramBin,
+    ProcessJob,
     Project,
     ProjectFileVariableConfig,
     RenderBase,
@@ -23,6 +24,7 @@ from api.models import (
     VariableHistogram,
 )
 
+from .artifact import ArtifactService
 from .variable import VariableService
 
 
@@ -69,6 +71,7 @@ class FileService:
         file_read.processed = file_project_link_obj.processed
         file_read.downsampling = file_project_link_obj.downsampling
         file_read.processed_path = file_project_link_obj.processed_path
+        file_read.output_format = file_project_link_obj.output_format
         file_read.order = file_project_link_obj.order
 
         variable_service = VariableService(self.session)
@@ -102,9 +105,15 @@ class FileService:
                 FileProjectLink.file_id == file_id,
             )
         ).first()
-        file_config.processed = False
-        os.remove(file_config.processed_path) if file_config.processed_path else None
-        file_config.processed_path = None
+        # Jobs for the previous configuration are superseded; speculative
+        # jobs process a preset and are kept
+        executor.cancel_jobs(
+            self.session,
+            ProcessJob.project_id == project_id,
+            ProcessJob.file_id == file_id,
+            ProcessJob.priority < PRIORITY_SPECULATIVE,
+        )
+        ArtifactService(self.session).release_artifact(file_config)
         file_config.order = file_update.order
 
         db_project = self.session.get(Project, project_id)
@@ -128,6 +137,7 @@ class FileService:
         file_read.processed = file_config.processed
         file_read.downsampling = file_config.downsampling
         file_read.processed_path = file_config.processed_path
+        file_read.output_format = file_config.output_format
         file_read.order = file_config.order
 
         variable_service = VariableService(self.session)
@@ -159,6 +169,9 @@ class FileService:
         file_read.processed = db_file[1].processed
         file_read.downsampling = db_file[1].downsampling
         file_read.processed_path = db_file[1].processed_path
+        file_read.output_format = db_file[1].output_format
+        if file_read.processed_path:
+            ArtifactService(self.session).touch_artifact(file_read.processed_path)
         return file_read
 
     def remove_files_from_project(
@@ -177,6 +190,12 @@ class FileService:
                 )
             ).first()
             if link:
+                executor.cancel_jobs(
+                    self.session,
+                    ProcessJob.project_id == project_id,
+                    ProcessJob.file_id == db_file.id,
+                )
+                ArtifactService(self.session).release_artifact(link)
                 self.session.delete(link)
 
             remaining_links = self.session.exec(
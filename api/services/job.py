@@ -1,15 +1,106 @@
-from threading import Thread
-from typing import Dict, Optional
+import hashlib
+import os
+import time
+import uuid
+from typing import Dict, List, Optional
 
-import msgpack
-from sqlmodel import Session, select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, and_, func, or_, select
 
+from api.config import SPECULATIVE_MAX_POINTS
 from api.db import SessionLocal
-from api.models import FileProjectLink, FileRead, ProcessJob
+from api.error_handlers import ProjectNotFoundError
+from api.events import broadcaster, iter_job_events, job_event
+from api.executor import (
+    JOB_STAGES,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_SPECULATIVE,
+    PROGRESS,
+    STAGE,
+    STOP,
+    STOP_PREEMPTED,
+    executor,
+)
+from api.models import (
+    File,
+    FileProjectLink,
+    FileRead,
+    ProcessJob,
+    ProcessOptions,
+    Project,
+)
 from api.utils import data_processor
+from src import writers
+from src.chunks import ChunkWriter, chunk_data_path, read_chunk_index, remove_chunks
+from src.processors import ProcessingCancelled, check_cancelled
 
+from .artifact import ArtifactService
 from .file import FileService
 
+# Seconds between progress writes to the job row while a job runs
+PROGRESS_PERSIST_INTERVAL = 2.0
+
+
+class JobProgress:
+    """Progress reporting of a running job.
+
+    Every update is stored in the state shared with the API process (when
+    the job runs in an executor worker); the job row is written at most
+    every PROGRESS_PERSIST_INTERVAL seconds, and on completion or failure.
+    """
+
+    def __init__(self, job_id: int, shared=None):
+        self.job_id = job_id
+        self.shared = shared
+        self.persisted_at = time.monotonic()
+
+    def set_stage(self, stage: str) -> None:
+        """Record the stage of the job.
+
+        Entering "writing" raises ProcessingCancelled if the dispatcher asked
+        the job to stop; both happen under the state's lock, so the job
+        cannot be preempted once it writes its artifact.
+        """
+        if self.shared is None:
+            return
+        with self.shared.get_lock():
+            if stage == "writing" and self.shared[STOP]:
+                raise ProcessingCancelled()
+            self.shared[STAGE] = JOB_STAGES.index(stage)
+
+    def preempted(self) -> bool:
+        """Whether the job was put back in the queue to make room for another."""
+        if self.shared is not None:
+            return self.shared[STOP] == STOP_PREEMPTED
+        return ProcessJobService._job_status(self.job_id) == "pending"
+
+    def update(self, progress: float) -> None:
+        if self.shared is not None:
+            self.shared[PROGRESS] = progress
+        now = time.monotonic()
+        if now - self.persisted_at >= PROGRESS_PERSIST_INTERVAL:
+            self.persisted_at = now
+            ProcessJobService._update_job_progress(self.job_id, progress)
+
+
+class JobCancelToken:
+    """Cancellation token of a running job.
+
+    In an executor worker it reads the STOP flag the dispatcher raises in the
+    shared state, so checking it between chunks costs no database query; a
+    job run outside the executor falls back to its status row.
+    """
+
+    def __init__(self, job_id: int, shared=None):
+        self.job_id = job_id
+        self.shared = shared
+
+    def is_set(self) -> bool:
+        if self.shared is not None:
+            return self.shared[STOP] != 0
+        return ProcessJobService._job_status(self.job_id) != "processing"
+
 
 class ProcessJobService:
     def __init__(self, session: Session):
@@ -25,128 +116,460 @@ class ProcessJobService:
         if not job:
             return {"error": "Job not found"}
 
+        if job.kind == "batch":
+            state = executor.batch_state(self.session, job)
+            if job.status != "processing":
+                # Finished batches report what was recorded when they ended
+                state.update(status=job.status, progress=job.progress, error=job.error)
+            return {
+                **state,
+                "stage": None,
+                "report": None,
+                "metrics": None,
+                "queue_position": None,
+            }
+
+        progress, stage = job.progress, None
+        if job.status == "processing":
+            progress = executor.live_progress(job_id) or progress
+            stage = executor.live_stage(job_id)
+
         return {
             "status": job.status,
-            "progress": job.progress,
+            "progress": progress,
+            "stage": stage,
             "error": job.error,
+            "report": job.report,
+            "metrics": {
+                "threads": job.threads,
+                "memory_estimate": job.memory_estimate,
+                "peak_memory": job.peak_memory,
+            },
+            "queue_position": self.get_queue_position(job),
         }
 
-    def get_job_result_path(self, job_id: int) -> Optional[str]:
-        """Get job result path if completed"""
+    def get_queue_position(self, job: ProcessJob) -> Optional[int]:
+        """1-based position of a pending job in the (priority, id) queue order"""
+        if job.status != "pending":
+            return None
+        return self.session.exec(
+            select(func.count()).where(
+                ProcessJob.status == "pending",
+                or_(
+                    ProcessJob.priority < job.priority,
+                    and_(ProcessJob.priority == job.priority, ProcessJob.id <= job.id),
+                ),
+            )
+        ).one()
+
+    def get_job_result(self, job_id: int) -> Optional[ProcessJob]:
+        """Get a job if it completed with a result"""
         job = self.get_job(job_id)
         if job and job.status == "done" and job.result_path:
-            return job.result_path
+            ArtifactService(self.session).touch_artifact(job.result_path)
+            return job
         return None
 
-    def start_file_processing(self, project_id: int, file_id: int) -> int:
-        """Start processing a single file in the background"""
+    def get_job_chunks(self, job_id: int) -> Optional[Dict]:
+        """List the chunks a job has published so far"""
+        job = self.get_job(job_id)
+        if not job:
+            return None
+
+        index = read_chunk_index(job_id) if job.status == "processing" else None
+        return {
+            "status": job.status,
+            "progress": job.progress,
+            "chunks": [
+                {
+                    "index": chunk["index"],
+                    "rows": chunk["rows"],
+                    "nbytes": chunk["nbytes"],
+                }
+                for chunk in (index or {"chunks": []})["chunks"]
+            ],
+        }
+
+    def get_job_chunk(self, job_id: int, chunk_index: int) -> Optional[Dict]:
+        """Locate a published chunk in the job's chunk file"""
+        job = self.get_job(job_id)
+        if not job or job.status != "processing":
+            return None
+        index = read_chunk_index(job_id)
+        if not index or not 0 <= chunk_index < len(index["chunks"]):
+            return None
+        return {**index["chunks"][chunk_index], "path": chunk_data_path(job_id)}
+
+    def cancel_job(self, job_id: int) -> Optional[ProcessJob]:
+        """Cancel a queued or running job; finished jobs are left unchanged"""
+        job = self.get_job(job_id)
+        if not job:
+            return None
+        job_ids = [job_id]
+        if job.kind == "batch":
+            job_ids += [entry["job_id"] for entry in job.payload["jobs"]]
+        executor.cancel_jobs(self.session, ProcessJob.id.in_(job_ids))
+        self.session.commit()
+        self.session.refresh(job)
+        return job
+
+    def stream_job_events(self, job_ids: List[int]):
+        """Event stream of the jobs, or None if one does not exist.
+
+        Call on the event loop. Subscribes before reading the current state,
+        so no transition between the two is lost.
+        """
+        queue = broadcaster.subscribe(job_ids)
+        snapshot = []
+        for job_id in job_ids:
+            if not self.get_job(job_id):
+                broadcaster.unsubscribe(queue, job_ids)
+                return None
+            progress = self.get_job_progress(job_id)
+            snapshot.append(
+                job_event(
+                    job_id,
+                    progress["status"],
+                    progress["progress"],
+                    progress["stage"],
+                    progress["error"],
+                )
+            )
+        return iter_job_events(queue, snapshot)
+
+    @staticmethod
+    def job_key(project_id: int, file_id: int, artifact_key: str) -> str:
+        """Identify a request by project file and effective configuration"""
+        return hashlib.sha256(
+            f"{project_id}:{file_id}:{artifact_key}".encode()
+        ).hexdigest()
+
+    def get_active_job(self, dedup_key: str) -> Optional[ProcessJob]:
+        """Get the queued or running job for a request key"""
+        return self.session.exec(
+            select(ProcessJob).where(
+                ProcessJob.dedup_key == dedup_key,
+                ProcessJob.status.in_(["pending", "processing"]),
+            )
+        ).first()
+
+    def start_file_processing(
+        self,
+        project_id: int,
+        file_id: int,
+        options: Optional[ProcessOptions] = None,
+        priority: int = PRIORITY_INTERACTIVE,
+        preset: Optional[FileRead] = None,
+    ) -> Optional[int]:
+        """Start processing a single file in the background.
+
+        Repeated requests for a file with the same configuration return the
+        job that is already queued or running instead of starting another;
+        that job is raised to the priority of the new request.
+
+        A preset replaces the project's configuration of the file without
+        being stored; its artifact is cached but not linked, and None is
+        returned when it is already cached.
+        """
+        options = options or ProcessOptions()
         file_service = FileService(self.session)
 
-        file_data = file_service.get_file(project_id, file_id)
+        file_data = preset or file_service.get_file(project_id, file_id)
         if not file_data:
             raise ValueError(
                 f"File with id {file_id} not found in project {project_id}"
             )
 
+        artifact_service = ArtifactService(self.session)
+        artifact_key = artifact_service.artifact_key(file_data, options)
+        artifact = artifact_service.get_artifact(artifact_key)
+        if artifact and preset:
+            return None
+        if artifact:
+            # Identical settings were already processed: reuse the artifact
+            artifact_service.link_artifact(project_id, file_id, artifact)
+            new_job = ProcessJob(
+                project_id=project_id,
+                file_id=file_id,
+                status="done",
+                progress=1.0,
+                result_path=artifact.path,
+                output_format=artifact.output_format,
+                report=artifact.report,
+            )
+            self.session.add(new_job)
+            self.session.commit()
+            self.session.refresh(new_job)
+            return new_job.id
+
+        dedup_key = self.job_key(project_id, file_id, artifact_key)
+        active_job = self.get_active_job(dedup_key)
+        if active_job:
+            if priority < active_job.priority:
+                active_job.priority = priority
+                self.session.commit()
+                executor.notify()
+            return active_job.id
+
         new_job = ProcessJob(
-            project_id=project_id, file_id=file_id, status="pending", progress=0.0
+            project_id=project_id,
+            file_id=file_id,
+            status="pending",
+            dedup_key=dedup_key,
+            priority=priority,
+            progress=0.0,
+            output_format=options.output_format,
+            payload={
+                "file": file_data.model_dump(mode="json"),
+                "options": options.model_dump(),
+                "artifact_key": artifact_key,
+            },
         )
         self.session.add(new_job)
-        self.session.commit()
+        try:
+            self.session.commit()
+        except IntegrityError:
+            # A concurrent identical request queued its job first
+            self.session.rollback()
+            return self.get_active_job(dedup_key).id
         self.session.refresh(new_job)
 
-        job_id = new_job.id
+        executor.notify()
+
+        return new_job.id
+
+    def start_project_processing(
+        self, project_id: int, options: Optional[ProcessOptions] = None
+    ) -> ProcessJob:
+        """Queue every file of a project as one batch job.
 
-        thread = Thread(
-            target=self._run_file_processing,
-            args=(job_id, project_id, file_data),
-            daemon=True,
+        File jobs are queued largest first (by point count), so the FIFO
+        queue hands the longest conversions to the workers first and the
+        batch finishes sooner. Each file's result is linked to the project
+        as soon as its job is done.
+        """
+        if not self.session.get(Project, project_id):
+            raise ProjectNotFoundError(project_id)
+        options = options or ProcessOptions()
+
+        files = self.session.exec(
+            select(File)
+            .join(FileProjectLink, FileProjectLink.file_id == File.id)
+            .where(FileProjectLink.project_id == project_id)
+        ).all()
+        files = sorted(
+            files,
+            key=lambda file: (file.total_points or 0, file.size or 0),
+            reverse=True,
+        )
+        jobs = [
+            {
+                "file_id": file.id,
+                "job_id": self.start_file_processing(
+                    project_id, file.id, options, PRIORITY_BATCH
+                ),
+                "weight": max(file.total_points or 0, 1),
+            }
+            for file in files
+        ]
+
+        batch = ProcessJob(
+            project_id=project_id,
+            kind="batch",
+            status="processing",
+            output_format=options.output_format,
+            payload={"jobs": jobs},
         )
-        thread.start()
+        self.session.add(batch)
+        self.session.commit()
+        self.session.refresh(batch)
+        return batch
+
+    def start_speculative_processing(self, project_id: int) -> List[int]:
+        """Pre-process the freshly ingested files of a project.
 
-        return job_id
+        Every file still on its ingestion defaults (no variable selected) of
+        at most SPECULATIVE_MAX_POINTS points is queued at
+        PRIORITY_SPECULATIVE with default options and a preset: the x/y/z
+        columns selected as axes, the ingestion thresholds and no
+        downsampling, as a first interactive request would send them. The
+        project's configuration is left as it is; when the user processes
+        the file with the same settings, the request is served from the
+        cache (or joins the job and raises its priority). Larger files are
+        skipped: no preset would match the downsampling a user picks for them.
+        """
+        file_service = FileService(self.session)
+        links = self.session.exec(
+            select(FileProjectLink).where(FileProjectLink.project_id == project_id)
+        ).all()
+        axes = {"x": "x_axis", "y": "y_axis", "z": "z_axis"}
+
+        job_ids = []
+        for link in links:
+            file_data = file_service.get_file(project_id, link.file_id)
+            names = {var.var_name for var in file_data.variables}
+            if (
+                any(var.selected for var in file_data.variables)
+                or not set(axes) <= names
+                or not file_data.total_points
+                or file_data.total_points > SPECULATIVE_MAX_POINTS
+            ):
+                continue
 
-    def _run_file_processing(self, job_id: int, project_id: int, file_data: FileRead):
-        """Run the actual file processing in background thread"""
+            variables = [
+                (
+                    {**var.model_dump(), "selected": True, axes[var.var_name]: True}
+                    if var.var_name in axes
+                    else var.model_dump()
+                )
+                for var in file_data.variables
+            ]
+            preset = FileRead.model_validate(
+                {**file_data.model_dump(), "variables": variables}
+            )
+            job_id = self.start_file_processing(
+                project_id,
+                link.file_id,
+                priority=PRIORITY_SPECULATIVE,
+                preset=preset,
+            )
+            if job_id is not None:
+                job_ids.append(job_id)
+        return job_ids
+
+    def run_job(self, job_id: int, state=None):
+        """Run a claimed job; called in a worker process.
+
+        state is the shared array the executor reads live progress from.
+        """
+        job = self.get_job(job_id)
+        if not job:
+            return
+        if not job.payload:
+            self._update_job_error(job_id, "Job has no processing settings")
+            return
+        self._run_file_processing(
+            job_id,
+            job.project_id,
+            FileRead.model_validate(job.payload["file"]),
+            ProcessOptions.model_validate(job.payload["options"]),
+            job.payload["artifact_key"],
+            JobProgress(job_id, state),
+        )
+
+    def _run_file_processing(
+        self,
+        job_id: int,
+        project_id: int,
+        file_data: FileRead,
+        options: ProcessOptions,
+        artifact_key: str,
+        job_progress: Optional[JobProgress] = None,
+    ):
+        """Run the actual file processing"""
+        job_progress = job_progress or JobProgress(job_id)
         with SessionLocal() as session:
             try:
 
                 def progress_callback(progress: float):
-                    progress = round(progress, 2)
-                    self._update_job_progress(job_id, progress)
-
-                self._update_job_status(job_id, "processing")
+                    job_progress.update(round(progress, 2))
 
+                job_progress.set_stage("converting")
+                cancel_token = JobCancelToken(job_id, job_progress.shared)
+                # Resumes from the chunks an interrupted attempt checkpointed
+                chunk_writer = ChunkWriter(job_id, key=artifact_key)
                 processed_file_data = data_processor.process_data(
                     file_config=file_data,
                     progress_callback=progress_callback,
+                    chunk_callback=chunk_writer.append,
+                    cancel_token=cancel_token,
+                    restored=chunk_writer.restore(),
+                    start=chunk_writer.completed,
                 )
+                check_cancelled(cancel_token)
+                job_progress.set_stage("writing")
 
-                result_path = f"./data/astrovisio_files/project_{project_id}_file_{file_data.id}_processed.msgpack"
-
-                data_dict = {
-                    "columns": processed_file_data.columns,
-                    "rows": processed_file_data.to_numpy().tolist(),
-                }
-                binary_data = msgpack.packb(data_dict, use_bin_type=True)
-
-                with open(result_path, "wb") as f:
-                    f.write(binary_data)
+                # Write next to the artifact and rename, so readers never see
+                # a partial file
+                result_path = ArtifactService.artifact_path(artifact_key, options)
+                tmp_path = f"{result_path}.{uuid.uuid4().hex}.tmp"
+                try:
+                    report = writers.write_output(
+                        processed_file_data, tmp_path, options, file_data
+                    )
+                    os.replace(tmp_path, result_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
 
                 with SessionLocal() as update_session:
-                    statement = select(FileProjectLink).where(
-                        FileProjectLink.project_id == project_id,
-                        FileProjectLink.file_id == file_data.id,
+                    artifact_service = ArtifactService(update_session)
+                    artifact = artifact_service.register_artifact(
+                        artifact_key, result_path, options.output_format, report
                     )
-                    file_link = update_session.exec(statement).first()
-                    file_link.processed = True
-                    file_link.processed_path = result_path
-                    update_session.add(file_link)
+                    # A job cancelled while writing still caches its artifact
+                    # (under the budget), but must not link it; neither does
+                    # a speculative job that no request joined
+                    job = update_session.get(ProcessJob, job_id)
+                    superseded = job.status != "processing"
+                    if not superseded and job.priority < PRIORITY_SPECULATIVE:
+                        artifact_service.link_artifact(
+                            project_id, file_data.id, artifact
+                        )
+                    artifact_service.enforce_budget(keep=artifact_key)
                     update_session.commit()
+                if superseded:
+                    raise ProcessingCancelled()
+
+                self._update_job_completion(job_id, result_path, report)
 
-                self._update_job_completion(job_id, result_path)
+            except ProcessingCancelled:
+                # The job row already records the cancellation or preemption
+                pass
 
             except Exception as e:
                 self._update_job_error(job_id, str(e))
 
-                self._update_job_completion(job_id, result_path)
+            finally:
+                # The artifact (or the error) supersedes the partial results;
+                # a preempted job keeps them as its checkpoint
+                if not job_progress.preempted():
+                    remove_chunks(job_id)
 
-            except Exception as e:
-                self._update_job_error(job_id, str(e))
+    @staticmethod
+    def _job_status(job_id: int) -> Optional[str]:
+        with SessionLocal() as session:
+            return session.exec(
+                select(ProcessJob.status).where(ProcessJob.id == job_id)
+            ).first()
 
-    def _update_job_progress(self, job_id: int, progress: float):
+    @staticmethod
+    def _update_job_progress(job_id: int, progress: float):
         """Update job progress"""
         with SessionLocal() as session:
             job = session.get(ProcessJob, job_id)
-            if job:
+            if job and job.status == "processing":
                 job.progress = progress
                 session.commit()
 
-    def _update_job_status(self, job_id: int, status: str, progress: float = None):
-        """Update job status and optionally progress"""
-        with SessionLocal() as session:
-            job = session.get(ProcessJob, job_id)
-            if job:
-                job.status = status
-                if progress is not None:
-                    job.progress = progress
-                session.commit()
-
-    def _update_job_completion(self, job_id: int, result_path: str):
+    def _update_job_completion(
+        self, job_id: int, result_path: str, report: Optional[dict] = None
+    ):
         """Mark job as completed with result path"""
         with SessionLocal() as session:
             job = session.get(ProcessJob, job_id)
-            if job:
+            if job and job.status == "processing":
                 job.status = "done"
                 job.progress = 1.0
                 job.result_path = result_path
+                job.report = report or None
                 session.commit()
 
     def _update_job_error(self, job_id: int, error_message: str):
         """Mark job as failed with error message"""
         with SessionLocal() as session:
             job = session.get(ProcessJob, job_id)
-            if job:
+            if job and job.status == "processing":
                 job.status = "error"
                 job.progress = 1.0
                 job.error = error_message
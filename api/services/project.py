@@ -4,10 +4,13 @@ from typing import List, Optional
 from sqlalchemy.orm import selectinload
 from sqlmodel import Session, select
 
+from api.config import SPECULATIVE_PROCESSING
 from api.error_handlers import ProjectNotFoundError
+from api.executor import executor
 from api.models import (
     File,
     FileProjectLink,
+    ProcessJob,
     Project,
     ProjectCreate,
     ProjectDuplicate,
@@ -18,7 +21,9 @@ from api.models import (
 )
 from api.utils import data_processor
 
+from .artifact import ArtifactService
 from .file import FileService
+from .job import ProcessJobService
 from .variable import VariableService
 
 
@@ -64,6 +69,8 @@ class ProjectService:
 
         self.session.commit()
         self.session.refresh(db_project)
+        if SPECULATIVE_PROCESSING:
+            ProcessJobService(self.session).start_speculative_processing(db_project.id)
         return self.get_project(db_project.id)
 
     def get_project(self, project_id: int) -> ProjectRead:
@@ -97,6 +104,7 @@ class ProjectService:
                         f.downsampling = file_config.downsampling
                         f.processed = file_config.processed
                         f.processed_path = file_config.processed_path
+                        f.output_format = file_config.output_format
                         f.order = file_config.order
                         for j, v in enumerate(f.variables):
                             if v.var_name == var.var_name:
@@ -135,6 +143,7 @@ class ProjectService:
                             f.downsampling = file_config.downsampling
                             f.processed = file_config.processed
                             f.processed_path = file_config.processed_path
+                            f.output_format = file_config.output_format
                             f.order = file_config.order
                             for j, v in enumerate(f.variables):
                                 if v.var_name == var.var_name:
@@ -179,6 +188,8 @@ class ProjectService:
 
             file_service.add_histos_to_file(file_histos_map)
             self.session.commit()
+            if SPECULATIVE_PROCESSING:
+                ProcessJobService(self.session).start_speculative_processing(project_id)
 
         return self.get_project(project_id)
 
@@ -220,6 +231,14 @@ class ProjectService:
         if not db_project:
             return False
 
+        executor.cancel_jobs(self.session, ProcessJob.project_id == project_id)
+        artifact_service = ArtifactService(self.session)
+        links = self.session.exec(
+            select(FileProjectLink).where(FileProjectLink.project_id == project_id)
+        ).all()
+        for link in links:
+            artifact_service.release_artifact(link)
+
         self.session.delete(db_project)
 
         cfgs = self.session.exec(
@@ -250,9 +269,23 @@ class ProjectService:
         self.session.flush()
 
         for file in db_project.files:
+            existing_link = self.session.exec(
+                select(FileProjectLink).where(
+                    FileProjectLink.project_id == db_project.id,
+                    FileProjectLink.file_id == file.id,
+                )
+            ).first()
+            # Share the processed artifact instead of recomputing it
             new_link = FileProjectLink(
                 project_id=new_project.id,
                 file_id=file.id,
+                downsampling=existing_link.downsampling,
+                processed=existing_link.artifact_key is not None,
+                processed_path=(
+                    existing_link.processed_path if existing_link.artifact_key else None
+                ),
+                artifact_key=existing_link.artifact_key,
+                output_format=existing_link.output_format,
             )
             self.session.add(new_link)
 
@@ -98,7 +98,14 @@ class DataProcessor:
         return mapping_files, mapping_histos
 
     @staticmethod
-    def process_data(file_config: FileRead, progress_callback=None) -> str:
+    def process_data(
+        file_config: FileRead,
+        progress_callback=None,
+        chunk_callback=None,
+        cancel_token=None,
+        restored: list = None,
+        start: int = 0,
+    ) -> str:
         combined_df = pl.DataFrame()
 
         def scaled_callback(progress):
@@ -106,11 +113,18 @@ class DataProcessor:
                 progress_callback(progress * 0.8)
 
         df = processors.convertToDataframe(
-            file=file_config, progress_callback=scaled_callback
+            file=file_config,
+            progress_callback=scaled_callback,
+            chunk_callback=chunk_callback,
+            cancel_token=cancel_token,
+            restored=restored,
+            start=start,
         )
         if progress_callback:
             progress_callback(0.85)
+        processors.check_cancelled(cancel_token)
         combined_df = pl.concat([combined_df, df]).unique()
+        del df
         if progress_callback:
             progress_callback(0.95)
         return combined_df
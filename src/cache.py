@@ -0,0 +1,50 @@
+import hashlib
+import os
+import uuid
+from typing import Optional
+
+import polars as pl
+
+from api.config import RAW_CACHE_DIR, RAW_CACHE_ENABLED
+
+
+def file_fingerprint(path: str) -> str:
+    """Identify a source file by its resolved path, size and modification time."""
+    real_path = os.path.realpath(path)
+    try:
+        stat = os.stat(real_path)
+        token = f"{real_path}:{stat.st_size}:{stat.st_mtime_ns}"
+    except OSError:
+        token = real_path
+    return hashlib.sha1(token.encode()).hexdigest()
+
+
+def _variable_path(path: str, var_name: str) -> str:
+    return os.path.join(RAW_CACHE_DIR, file_fingerprint(path), f"{var_name}.arrow")
+
+
+def read_cached_variable(path: str, var_name: str) -> Optional[pl.Series]:
+    """Memory-map a cached variable, or return None when it is not cached."""
+    if not RAW_CACHE_ENABLED:
+        return None
+    var_path = _variable_path(path, var_name)
+    if not os.path.exists(var_path):
+        return None
+    series = pl.read_ipc(var_path, memory_map=True).to_series()
+    # The entry's modification time orders it for least-recently-used eviction
+    try:
+        os.utime(os.path.dirname(var_path))
+    except OSError:
+        pass
+    return series
+
+
+def write_cached_variable(path: str, series: pl.Series) -> None:
+    """Store a converted variable as an uncompressed (mmap-able) Arrow IPC file."""
+    if not RAW_CACHE_ENABLED:
+        return
+    var_path = _variable_path(path, series.name)
+    os.makedirs(os.path.dirname(var_path), exist_ok=True)
+    tmp_path = f"{var_path}.{uuid.uuid4().hex}.tmp"
+    series.to_frame().write_ipc(tmp_path, compression="uncompressed")
+    os.replace(tmp_path, var_path)
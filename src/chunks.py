@@ -0,0 +1,121 @@
+import json
+import os
+import shutil
+import uuid
+from typing import Optional
+
+import polars as pl
+
+from api.config import PARTIAL_DIR
+from src.readers import read_columnar_frame
+from src.writers import columnar_layout, write_columnar_data
+
+INDEX_NAME = "index.json"
+DATA_NAME = "chunks.bin"
+
+
+def chunk_dir(job_id: int) -> str:
+    return os.path.join(PARTIAL_DIR, str(job_id))
+
+
+class ChunkWriter:
+    """Append-only store for the chunks a job publishes while it runs.
+
+    Chunks are columnar artifacts appended to a single data file. The index
+    ({"chunks": [{"index", "offset", "nbytes", "rows"}], "completed", "key",
+    "schema"}) is replaced atomically after each append, so readers only ever
+    see chunks that were fully written. "completed" counts the source chunks
+    processed so far, including those left empty by filtering.
+
+    The store doubles as the job's checkpoint: created with the key of a
+    previous attempt of the same job, it keeps the chunks that attempt
+    completed. The store is removed once the job finishes.
+    """
+
+    def __init__(self, job_id: int, key: Optional[str] = None):
+        self.directory = chunk_dir(job_id)
+        os.makedirs(self.directory, exist_ok=True)
+        self.data_path = os.path.join(self.directory, DATA_NAME)
+        self.index = {"chunks": [], "completed": 0, "key": key, "schema": None}
+        self.offset = 0
+
+        previous = read_chunk_index(job_id)
+        if key is not None and previous and previous.get("key") == key:
+            end = sum(chunk["nbytes"] for chunk in previous["chunks"])
+            if (
+                os.path.exists(self.data_path)
+                and os.path.getsize(self.data_path) >= end
+            ):
+                # Drop whatever a crash left after the last indexed chunk
+                os.truncate(self.data_path, end)
+                self.index = previous
+                self.offset = end
+                return
+        open(self.data_path, "wb").close()
+        self._write_index()
+
+    @property
+    def completed(self) -> int:
+        return self.index["completed"]
+
+    def restore(self) -> list:
+        """Frames of the chunks kept from a previous attempt, in their dtypes."""
+        frames = []
+        schema = {
+            name: getattr(pl, dtype)
+            for name, dtype in (self.index["schema"] or {}).items()
+        }
+        with open(self.data_path, "rb") as f:
+            for chunk in self.index["chunks"]:
+                f.seek(chunk["offset"])
+                frames.append(read_columnar_frame(f.read(chunk["nbytes"])).cast(schema))
+        return frames
+
+    def _write_index(self) -> None:
+        index_path = os.path.join(self.directory, INDEX_NAME)
+        tmp_path = f"{index_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, index_path)
+
+    def append(self, df: pl.DataFrame) -> None:
+        self.index["completed"] += 1
+        if df.height == 0:
+            self._write_index()
+            return
+        if self.index["schema"] is None:
+            self.index["schema"] = {
+                name: str(dtype) for name, dtype in df.schema.items()
+            }
+        header, arrays, _ = columnar_layout(df)
+        with open(self.data_path, "ab") as f:
+            nbytes = write_columnar_data(f, header, arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        self.index["chunks"].append(
+            {
+                "index": len(self.index["chunks"]),
+                "offset": self.offset,
+                "nbytes": nbytes,
+                "rows": df.height,
+            }
+        )
+        self.offset += nbytes
+        self._write_index()
+
+
+def read_chunk_index(job_id: int) -> Optional[dict]:
+    """Return the chunk index of a job, or None when it published nothing."""
+    try:
+        with open(os.path.join(chunk_dir(job_id), INDEX_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def chunk_data_path(job_id: int) -> str:
+    return os.path.join(chunk_dir(job_id), DATA_NAME)
+
+
+def remove_chunks(job_id: int) -> None:
+    shutil.rmtree(chunk_dir(job_id), ignore_errors=True)
@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import lz4.frame
+import polars as pl
+import zstandard
+
+# Artifact file suffix per stored content encoding
+EXTENSIONS = {"zstd": ".zst", "lz4": ".lz4"}
+ZSTD_LEVEL = 3
+LZ4_BLOCK_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def encoding_for_path(path: str):
+    """Return the content encoding of an artifact from its suffix, or None."""
+    return next(
+        (
+            encoding
+            for encoding, extension in EXTENSIONS.items()
+            if path.endswith(extension)
+        ),
+        None,
+    )
+
+
+def byte_shuffle(data) -> bytes:
+    """Group the i-th byte of every element together, as blosc's shuffle does.
+
+    Neighbouring float32 values share sign, exponent and leading mantissa bits,
+    so shuffled buffers compress markedly better.
+    """
+    return data.view("u1").reshape(-1, data.itemsize).T.tobytes()
+
+
+class _ParallelLZ4Writer:
+    """Compress fixed-size blocks as independent LZ4 frames on a thread pool.
+
+    Concatenated frames form a valid LZ4 stream, so readers decode the
+    result with a plain lz4.frame reader.
+    """
+
+    def __init__(self, f, threads: int):
+        self.f = f
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.buffer = bytearray()
+
+    def write(self, data) -> None:
+        self.buffer += data
+        if len(self.buffer) >= LZ4_BLOCK_SIZE * self.threads:
+            self._flush()
+
+    def _flush(self) -> None:
+        blocks = [
+            bytes(self.buffer[i : i + LZ4_BLOCK_SIZE])
+            for i in range(0, len(self.buffer), LZ4_BLOCK_SIZE)
+        ]
+        self.buffer = bytearray()
+        for frame in self.pool.map(lz4.frame.compress, blocks):
+            self.f.write(frame)
+
+    def close(self) -> None:
+        if self.buffer:
+            self._flush()
+        self.pool.shutdown()
+
+
+@contextmanager
+def open_writer(path: str, compression: str = "none", threads: int = 0):
+    """Open an artifact for writing, compressing on the fly when requested."""
+    # Follow the polars pool, which a worker's thread budget sizes
+    threads = threads or pl.thread_pool_size()
+    with open(path, "wb") as f:
+        if compression == "zstd":
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=threads)
+            with compressor.stream_writer(f, closefd=False) as writer:
+                yield writer
+        elif compression == "lz4":
+            writer = _ParallelLZ4Writer(f, threads)
+            try:
+                yield writer
+            finally:
+                writer.close()
+        else:
+            yield f
+
+
+def iter_decompressed(path: str, encoding: str):
+    """Yield the decoded content of a compressed artifact in chunks."""
+    with open(path, "rb") as f:
+        if encoding == "zstd":
+            reader = zstandard.ZstdDecompressor().stream_reader(f)
+        else:
+            reader = lz4.frame.open(f, "rb")
+        with reader:
+            while chunk := reader.read(READ_SIZE):
+                yield chunk
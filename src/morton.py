@@ -0,0 +1,91 @@
+from typing import Optional
+
+import numpy as np
+import polars as pl
+
+# Bits per axis; three axes interleave into a 63-bit code
+BITS = 21
+# Rows per block whose bounding box is recorded with spatially ordered output
+BLOCK_ROWS = 1 << 16
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    """Insert two zero bits between each of the low 21 bits of v."""
+    v = v & np.uint64(0x1FFFFF)
+    v = (v | v << np.uint64(32)) & np.uint64(0x1F00000000FFFF)
+    v = (v | v << np.uint64(16)) & np.uint64(0x1F0000FF0000FF)
+    v = (v | v << np.uint64(8)) & np.uint64(0x100F00F00F00F00F)
+    v = (v | v << np.uint64(4)) & np.uint64(0x10C30C30C30C30C3)
+    v = (v | v << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return v
+
+
+def axis_bounds(columns: list) -> tuple:
+    """Finite min/max of each axis column."""
+    mins, maxs = [], []
+    for values in columns:
+        finite = values[np.isfinite(values)]
+        mins.append(float(finite.min()) if finite.size else 0.0)
+        maxs.append(float(finite.max()) if finite.size else 0.0)
+    return mins, maxs
+
+
+def grid_coordinates(values: np.ndarray, vmin: float, vmax: float) -> np.ndarray:
+    """Map values onto the 2**BITS cells spanning [vmin, vmax]."""
+    span = vmax - vmin
+    if not span > 0:
+        return np.zeros(len(values), dtype=np.uint64)
+    cells = np.floor((values.astype(np.float64) - vmin) * ((1 << BITS) / span))
+    cells = np.nan_to_num(cells, nan=0.0, posinf=(1 << BITS) - 1, neginf=0.0)
+    return np.clip(cells, 0, (1 << BITS) - 1).astype(np.uint64)
+
+
+def morton_codes(columns: list, bounds: tuple = None) -> np.ndarray:
+    """3D Morton codes of the x/y/z columns, x in the lowest bit of each triple.
+
+    The top 3 * L bits of a code identify the level-L octree cell of a point,
+    so sorting by code groups points cell by cell at every level.
+    """
+    mins, maxs = bounds or axis_bounds(columns)
+    codes = np.zeros(len(columns[0]), dtype=np.uint64)
+    for shift, (values, vmin, vmax) in enumerate(zip(columns, mins, maxs)):
+        codes |= _spread_bits(grid_coordinates(values, vmin, vmax)) << np.uint64(shift)
+    return codes
+
+
+def morton_sort(df: pl.DataFrame, axes: list) -> pl.DataFrame:
+    """Reorder rows along the Morton curve of the axis columns."""
+    codes = morton_codes([df[name].cast(pl.Float32).to_numpy() for name in axes])
+    return df[np.argsort(codes, kind="stable")]
+
+
+def block_bounds(df: pl.DataFrame, axes: list, block_rows: int = BLOCK_ROWS) -> list:
+    """Bounding box of every block of block_rows consecutive rows.
+
+    Returns [{"row", "rows", "min": [x, y, z], "max": [x, y, z]}, ...];
+    non-finite values are ignored, and an axis without finite values in a
+    block has None bounds.
+    """
+    starts = np.arange(0, df.height, block_rows)
+    if len(starts) == 0:
+        return []
+    mins, maxs = [], []
+    for name in axes:
+        values = df[name].cast(pl.Float32).to_numpy()
+        values = np.where(np.isfinite(values), values, np.nan)
+        # fmin/fmax skip NaNs, unless a block holds nothing else
+        mins.append(np.fmin.reduceat(values, starts))
+        maxs.append(np.fmax.reduceat(values, starts))
+    return [
+        {
+            "row": int(start),
+            "rows": int(min(block_rows, df.height - start)),
+            "min": [_finite_or_none(values[i]) for values in mins],
+            "max": [_finite_or_none(values[i]) for values in maxs],
+        }
+        for i, start in enumerate(starts)
+    ]
+
+
+def _finite_or_none(value) -> Optional[float]:
+    return float(value) if np.isfinite(value) else None
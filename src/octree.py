@@ -0,0 +1,157 @@
+import os
+import struct
+from collections import deque
+from functools import lru_cache
+
+import msgpack
+import numpy as np
+import polars as pl
+
+from src.morton import BITS, axis_bounds, morton_codes
+from src.writers import _padding, columnar_layout, write_columnar_data
+
+OCTREE_MAGIC = b"AVOCT\x00\x01\x00"
+# Points kept by an inner node; leaves hold whatever remains below them
+NODE_POINTS = 1 << 16
+MAX_DEPTH = 12
+FOOTER = struct.Struct("<Q8s")
+
+
+def _code_range(codes: np.ndarray, level: int, prefix: int) -> tuple:
+    """Rows [lo, hi) of the sorted codes that fall into a level-L cell."""
+    shift = 3 * (BITS - level)
+    lo, hi = np.searchsorted(
+        codes, np.array([prefix << shift, (prefix + 1) << shift], dtype=np.uint64)
+    )
+    return int(lo), int(hi)
+
+
+def write_octree(
+    df: pl.DataFrame,
+    path: str,
+    axes: list,
+    node_points: int = NODE_POINTS,
+    max_depth: int = MAX_DEPTH,
+) -> dict:
+    """Multi-resolution octree over the axis columns, one tile per node.
+
+    Rows are sorted by Morton code, so every octree cell is a contiguous
+    range found by binary search. Each inner node keeps node_points rows
+    spread evenly over its cell in Morton order (a spatially uniform
+    subsample); its children refine it with the rows it did not keep.
+    Nodes are written breadth-first, coarse levels first.
+
+    File layout:
+        magic (8 bytes) | tiles, each starting on a 64-byte boundary
+        | msgpack index | index offset (uint64 LE) | magic
+
+    Each tile is a columnar artifact. The index lists the axes, bounds and,
+    per node, its id ("r" followed by one octant digit per level), level,
+    point count, cell bounds, tile offset/nbytes and child ids.
+
+    Returns a report with the node count and depth.
+    """
+    positions = [df[name].cast(pl.Float32).to_numpy() for name in axes]
+    mins, maxs = axis_bounds(positions)
+    codes = morton_codes(positions, (mins, maxs))
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    taken = np.zeros(len(codes), dtype=bool)
+    spans = [vmax - vmin for vmin, vmax in zip(mins, maxs)]
+
+    nodes = []
+    queue = deque([("r", 0, 0, (0, 0, 0))])
+    with open(path, "wb") as f:
+        f.write(OCTREE_MAGIC)
+        position = len(OCTREE_MAGIC)
+        while queue:
+            node_id, level, prefix, cell = queue.popleft()
+            lo, hi = _code_range(codes, level, prefix)
+            remaining = np.flatnonzero(~taken[lo:hi]) + lo
+
+            children = []
+            if len(remaining) > node_points and level < max_depth:
+                keep = remaining[
+                    np.linspace(0, len(remaining) - 1, node_points).astype(np.int64)
+                ]
+                taken[keep] = True
+                for octant in range(8):
+                    child_prefix = prefix * 8 + octant
+                    child_lo, child_hi = _code_range(codes, level + 1, child_prefix)
+                    if taken[child_lo:child_hi].sum() < child_hi - child_lo:
+                        child_cell = tuple(
+                            c * 2 + ((octant >> axis) & 1)
+                            for axis, c in enumerate(cell)
+                        )
+                        children.append(f"{node_id}{octant}")
+                        queue.append(
+                            (children[-1], level + 1, child_prefix, child_cell)
+                        )
+            else:
+                keep = remaining
+                taken[keep] = True
+
+            padding = _padding(position)
+            f.write(b"\0" * padding)
+            position += padding
+            header, arrays, _ = columnar_layout(df[order[keep]])
+            nbytes = write_columnar_data(f, header, arrays)
+            nodes.append(
+                {
+                    "id": node_id,
+                    "level": level,
+                    "count": len(keep),
+                    "bounds": {
+                        "min": [
+                            vmin + c * span / (1 << level)
+                            for vmin, span, c in zip(mins, spans, cell)
+                        ],
+                        "max": [
+                            vmin + (c + 1) * span / (1 << level)
+                            for vmin, span, c in zip(mins, spans, cell)
+                        ],
+                    },
+                    "offset": position,
+                    "nbytes": nbytes,
+                    "children": children,
+                }
+            )
+            position += nbytes
+
+        index = {
+            "format": "octree",
+            "version": 1,
+            "axes": axes,
+            "length": df.height,
+            "bounds": {"min": mins, "max": maxs},
+            "node_points": node_points,
+            "nodes": nodes,
+        }
+        f.write(msgpack.packb(index, use_bin_type=True))
+        f.write(FOOTER.pack(position, OCTREE_MAGIC))
+
+    return {
+        "octree": {
+            "nodes": len(nodes),
+            "depth": max(node["level"] for node in nodes),
+        }
+    }
+
+
+@lru_cache(maxsize=32)
+def _read_index(path: str, mtime_ns: int, size: int) -> dict:
+    with open(path, "rb") as f:
+        f.seek(size - FOOTER.size)
+        index_offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != OCTREE_MAGIC:
+            raise ValueError("Not an octree artifact")
+        f.seek(index_offset)
+        index = msgpack.unpackb(f.read(size - FOOTER.size - index_offset))
+    index["by_id"] = {node["id"]: node for node in index["nodes"]}
+    return index
+
+
+def read_octree_index(path: str) -> dict:
+    """Index of an octree artifact, cached until the file changes."""
+    stat = os.stat(path)
+    return _read_index(path, stat.st_mtime_ns, stat.st_size)
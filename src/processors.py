@@ -1,28 +1,90 @@
 import gc
+from typing import Optional
 
+import numpy as np
 import polars as pl
 from astropy.table import Table
 
+from api.config import DOWNSAMPLING_SEED
 from api.models import FileRead
+from src.cache import read_cached_variable, write_cached_variable
 from src.loaders import load_data
 from src.utils import getFileType
 
 
-def downsample_dataframe(file: FileRead, df: pl.DataFrame) -> pl.DataFrame:
-    if file and "downsampling" in file.model_dump():
-        df = df.sample(fraction=file.downsampling)
+class ProcessingCancelled(Exception):
+    """Raised between chunks when the job was cancelled"""
+
+
+def check_cancelled(cancel_token) -> None:
+    """Raise if the token (anything with is_set(), e.g. an Event) is set."""
+    if cancel_token is not None and cancel_token.is_set():
+        raise ProcessingCancelled()
+
+
+def downsample_dataframe(
+    file: FileRead, df: pl.DataFrame, seed: int = DOWNSAMPLING_SEED
+) -> pl.DataFrame:
+    """Keep each row with probability downsampling.
+
+    A seeded Bernoulli mask rather than a fixed-size sample: the expected
+    number of rows kept does not depend on how the data is chunked, so small
+    chunks are not rounded down to nothing.
+    """
+    if file and "downsampling" in file.model_dump() and file.downsampling < 1:
+        keep = np.random.default_rng(seed).random(df.height) < file.downsampling
+        df = df.filter(pl.Series(keep))
     return df
 
 
+FITS_COLUMNS = ["x", "y", "z", "value"]
+FITS_SCHEMA = {"x": pl.UInt16, "y": pl.UInt16, "z": pl.UInt16, "value": pl.Float32}
+# Rows per chunk when a source is already loaded as whole columns
+ROW_BLOCK = 1 << 20
+
+
+def row_blocks(df: pl.DataFrame, start: int = 0):
+    for offset in range(start * ROW_BLOCK, max(df.height, 1), ROW_BLOCK):
+        yield df.slice(offset, ROW_BLOCK)
+
+
 def fits_to_dataframe(file_path: str, progress_callback=None):
+    slabs = list(iter_fits_chunks(file_path, progress_callback))
+    return pl.concat(slabs) if slabs else pl.DataFrame(schema=FITS_SCHEMA)
+
+
+def iter_fits_chunks(file_path: str, progress_callback=None, start: int = 0):
+    """Yield the cube as one frame per non-empty spectral slab.
+
+    Slabs are the same whether the cube is read from the raw cache or
+    converted (and then cached), so per-chunk processing is reproducible.
+    The first start non-empty slabs are skipped without being converted; the
+    raw cache is only written when every slab was converted.
+    """
+
+    cached = [read_cached_variable(file_path, col) for col in FITS_COLUMNS]
+    if all(series is not None for series in cached):
+        if progress_callback:
+            progress_callback(1.0)
+        slabs = pl.DataFrame(cached).partition_by("z", maintain_order=True)
+        yield from slabs[start:]
+        return
 
     # Load the spectral cube
     with load_data(file_path) as obs:
         table = Table(obs[0].data)
 
-        def expand_table(table, progress_callback=None):
+        def expand_table(table, progress_callback=None, start=0):
             total = len(table.columns)
+            skipped = 0
             for idx, col in enumerate(table.columns):
+                if skipped < start:
+                    # Only tell whether the slab yields any rows
+                    values = np.asarray(table[col])
+                    skipped += bool(np.any((values != 0) & ~np.isnan(values)))
+                    if progress_callback:
+                        progress_callback((idx + 1) / total)
+                    continue
                 df = pl.from_pandas(Table(table[col]).to_pandas())
                 df.columns = [str(i) for i in range(len(df.columns))]
                 df = df.with_row_index("y").with_columns(pl.col("y").cast(pl.UInt16))
@@ -36,66 +98,147 @@ def fits_to_dataframe(file_path: str, progress_callback=None):
                     progress_callback((idx + 1) / total)
                 yield (df)
 
-        df = pl.concat(expand_table(table, progress_callback))[["x", "y", "z", "value"]]
+        slabs = []
+        for slab in expand_table(table, progress_callback, start):
+            if slab.height == 0:
+                continue
+            slab = slab.with_columns(pl.col("value").cast(pl.Float32))
+            slabs.append(slab)
+            yield slab
 
         del table
 
     del obs
     gc.collect()
 
-    return df
+    if start:
+        return
+    df = pl.concat(slabs) if slabs else pl.DataFrame(schema=FITS_SCHEMA)
+    for col in FITS_COLUMNS:
+        write_cached_variable(file_path, df[col])
+
 
+def pynbody_to_dataframe(
+    file: FileRead, family=None, progress_callback=None, cancel_token=None
+):
+    """Load the selected variables as one frame.
 
-def pynbody_to_dataframe(file: FileRead, family=None, progress_callback=None):
-    with load_data(file.path) as sim:
+    The token is checked after each variable is converted; converted
+    variables are already in the raw cache, so a stopped job that runs
+    again only converts the remaining ones.
+    """
+    selected = [var.var_name for var in file.variables if var.selected]
+    total = len(selected)
 
-        sim.physical_units()
+    columns = {}
+    for var_name in selected:
+        cached = read_cached_variable(file.path, var_name)
+        if cached is not None:
+            columns[var_name] = cached
+            if progress_callback:
+                progress_callback(len(columns) / total)
+
+    missing = [var_name for var_name in selected if var_name not in columns]
+    if missing:
+        with load_data(file.path) as sim:
+
+            sim.physical_units()
 
-        def variable_series(sim, file, progress_callback=None):
             dtype = pl.Float32
-            total = len(file.variables)
-            for idx, var in enumerate(file.variables):
-                var_name = var.var_name
-                if var.selected:
-                    if "-" in var_name:
-                        base_key, i = var_name.split("-")
-                        name = f"{base_key}-{i}"
-                        arr = sim[base_key][:, int(i)]
-                    else:
-                        name = var_name
-                        arr = sim[var_name]
-                    if progress_callback:
-                        progress_callback((idx + 1) / total)
-                    yield pl.Series(name=name, values=arr, dtype=dtype)
+            for var_name in missing:
+                if "-" in var_name:
+                    base_key, i = var_name.split("-")
+                    arr = sim[base_key][:, int(i)]
+                else:
+                    arr = sim[var_name]
+                series = pl.Series(name=var_name, values=arr, dtype=dtype)
+                write_cached_variable(file.path, series)
+                columns[var_name] = series
+                if progress_callback:
+                    progress_callback(len(columns) / total)
+                check_cancelled(cancel_token)
 
-        df = pl.DataFrame(variable_series(sim, file, progress_callback))
+        del sim
+        gc.collect()
 
-    del sim
-    gc.collect()
+    return pl.DataFrame([columns[var_name] for var_name in selected])
 
-    return df
+
+def selection_thresholds(var) -> Optional[tuple]:
+    """Thresholds a variable is filtered on, or None when it is not filtered.
+
+    Unselected variables and unset (or zero) thresholds do not filter. A
+    selection of the whole range still does: it drops non-finite values.
+    """
+    if var.selected and var.thr_min_sel and var.thr_max_sel:
+        return var.thr_min_sel, var.thr_max_sel
+    return None
 
 
 def filter_dataframe(df: pl.DataFrame, file: FileRead) -> pl.DataFrame:
     filtered_df: pl.DataFrame = df.clone()
 
     for var in file.variables:
-        if var.selected and var.thr_min_sel and var.thr_max_sel:
+        thresholds = selection_thresholds(var)
+        if thresholds:
             filtered_df = filtered_df.filter(
-                pl.col(var.var_name).is_between(var.thr_min_sel, var.thr_max_sel)
+                pl.col(var.var_name).is_between(*thresholds)
             )
 
     return filtered_df
 
 
-def convertToDataframe(
-    file: FileRead, family=None, progress_callback=None
-) -> pl.DataFrame:
-    if getFileType(file.path) == "fits":
-        df = fits_to_dataframe(file.path, progress_callback)
+def iter_chunks(
+    file: FileRead,
+    family=None,
+    progress_callback=None,
+    start: int = 0,
+    cancel_token=None,
+):
+    """Yield the processed data chunk by chunk (FITS slabs, HDF5 row blocks).
 
+    Each chunk is downsampled with a seed derived from its position and
+    filtered on its own, so the concatenated chunks are reproducible and a
+    resumed run skips the first start chunks without converting them again.
+    """
+    if getFileType(file.path) == "fits":
+        chunks = iter_fits_chunks(file.path, progress_callback, start)
     else:
-        df = pynbody_to_dataframe(file, family, progress_callback)
-    df = downsample_dataframe(file, df)
+        chunks = row_blocks(
+            pynbody_to_dataframe(file, family, progress_callback, cancel_token),
+            start,
+        )
 
-    return filter_dataframe(df, file)
+    for index, chunk in enumerate(chunks, start):
+        chunk = downsample_dataframe(file, chunk, seed=DOWNSAMPLING_SEED + index)
+        yield filter_dataframe(chunk, file)
+
+
+def convertToDataframe(
+    file: FileRead,
+    family=None,
+    progress_callback=None,
+    chunk_callback=None,
+    cancel_token=None,
+    restored: list = None,
+    start: int = 0,
+) -> pl.DataFrame:
+    """Concatenate the processed chunks of a file.
+
+    An interrupted run resumes with the frames it restored from its first
+    start chunks (empty chunks leave no frame); processing continues from
+    chunk start.
+    """
+    chunks = list(restored or [])
+    try:
+        for chunk in iter_chunks(file, family, progress_callback, start, cancel_token):
+            check_cancelled(cancel_token)
+            if chunk_callback:
+                chunk_callback(chunk)
+            chunks.append(chunk)
+    except ProcessingCancelled:
+        # The traceback keeps this frame alive; drop the chunks now
+        chunks.clear()
+        gc.collect()
+        raise
+    return pl.concat(chunks) if chunks else pl.DataFrame()
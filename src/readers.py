@@ -0,0 +1,267 @@
+import io
+import struct
+import tempfile
+from typing import List, Optional
+
+import msgpack
+import numpy as np
+import polars as pl
+
+from src.compression import READ_SIZE, encoding_for_path, iter_decompressed
+from src.writers import ALIGNMENT, COLUMNAR_MAGIC, _padding, _write_preamble
+
+# Rows interleaved at a time when projecting a byte-shuffled column
+PROJECTION_ROWS = 1 << 16
+
+
+class _RangeReader:
+    """Read ascending byte ranges from an artifact.
+
+    Plain files are read with seeks; compressed artifacts are decoded as a
+    stream and the bytes between ranges are skipped.
+    """
+
+    def __init__(self, path: str):
+        self.encoding = encoding_for_path(path)
+        if self.encoding:
+            self.chunks = iter_decompressed(path, self.encoding)
+            self.buffer = b""
+            self.position = 0
+        else:
+            self.file = open(path, "rb")
+
+    def close(self) -> None:
+        if self.encoding:
+            self.chunks.close()
+        else:
+            self.file.close()
+
+    def _next_chunk(self) -> bytes:
+        if self.buffer:
+            chunk, self.buffer = self.buffer, b""
+            return chunk
+        chunk = next(self.chunks, b"")
+        if not chunk:
+            raise ValueError("Unexpected end of artifact")
+        return chunk
+
+    def iter_range(self, start: int, size: int):
+        """Yield the bytes of [start, start + size) in chunks."""
+        if not self.encoding:
+            self.file.seek(start)
+            while size > 0:
+                chunk = self.file.read(min(READ_SIZE, size))
+                if not chunk:
+                    raise ValueError("Unexpected end of artifact")
+                size -= len(chunk)
+                yield chunk
+            return
+
+        if start < self.position:
+            raise ValueError("Ranges must be read in ascending order")
+        while self.position < start:
+            chunk = self._next_chunk()
+            skip = min(len(chunk), start - self.position)
+            self.position += skip
+            self.buffer = chunk[skip:]
+        while size > 0:
+            chunk = self._next_chunk()
+            part, self.buffer = chunk[:size], chunk[size:]
+            self.position += len(part)
+            size -= len(part)
+            yield part
+
+    def read(self, start: int, size: int) -> bytes:
+        return b"".join(self.iter_range(start, size))
+
+
+def read_columnar_header(reader: _RangeReader) -> tuple:
+    """Return the header of a columnar artifact and the start of its data section."""
+    preamble = reader.read(0, len(COLUMNAR_MAGIC) + 4)
+    if preamble[: len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+        raise ValueError("Projection requires a columnar artifact")
+    (header_len,) = struct.unpack("<I", preamble[len(COLUMNAR_MAGIC) :])
+    header = msgpack.unpackb(reader.read(len(preamble), header_len))
+    data_start = len(preamble) + header_len
+    return header, data_start + _padding(data_start)
+
+
+def read_columnar_frame(data: bytes) -> pl.DataFrame:
+    """DataFrame of an unshuffled, unquantized columnar artifact held in memory."""
+    if data[: len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar artifact")
+    (header_len,) = struct.unpack_from("<I", data, len(COLUMNAR_MAGIC))
+    data_start = len(COLUMNAR_MAGIC) + 4 + header_len
+    header = msgpack.unpackb(data[len(COLUMNAR_MAGIC) + 4 : data_start])
+    data_start += _padding(data_start)
+    return pl.DataFrame(
+        {
+            col["name"]: np.frombuffer(
+                data, col["dtype"], header["length"], data_start + col["offset"]
+            )
+            for col in header["columns"]
+        }
+    )
+
+
+def _iter_unshuffled(
+    reader: _RangeReader,
+    col_start: int,
+    total: int,
+    start: int,
+    count: int,
+    itemsize: int,
+):
+    """Yield rows [start, start + count) of a byte-shuffled column.
+
+    Byte plane k holds byte k of every value. Rows are interleaved back in
+    windows of PROJECTION_ROWS, so memory does not grow with the projection.
+    A decoded stream only moves forward, so the requested part of each plane
+    is first spooled to a temporary file and the windows are read from there.
+    """
+    spool = None
+    if reader.encoding:
+        spool = tempfile.TemporaryFile()
+        for k in range(itemsize):
+            for chunk in reader.iter_range(col_start + k * total + start, count):
+                spool.write(chunk)
+
+    def read_plane(k: int, row: int, rows: int) -> bytes:
+        if spool is None:
+            return reader.read(col_start + k * total + start + row, rows)
+        spool.seek(k * count + row)
+        return spool.read(rows)
+
+    try:
+        for row in range(0, count, PROJECTION_ROWS):
+            rows = min(PROJECTION_ROWS, count - row)
+            window = np.empty((rows, itemsize), dtype="u1")
+            for k in range(itemsize):
+                window[:, k] = np.frombuffer(read_plane(k, row, rows), dtype="u1")
+            yield window.tobytes()
+    finally:
+        if spool is not None:
+            spool.close()
+
+
+def columnar_projection(
+    path: str,
+    columns: Optional[List[str]] = None,
+    offset: int = 0,
+    limit: Optional[int] = None,
+) -> tuple:
+    """Project a columnar artifact onto a column subset and a row range.
+
+    Only the requested byte ranges are read. The result is a columnar
+    artifact of its own (uncompressed and unshuffled, columns in artifact
+    order) whose header adds "row_offset" and "total_length"; min/max still
+    describe the full columns.
+
+    Returns the size of the projection in bytes and an iterator over its content.
+    """
+    reader = _RangeReader(path)
+    try:
+        header, data_start = read_columnar_header(reader)
+        total = header["length"]
+        names = [col["name"] for col in header["columns"]]
+        unknown = set(columns or []) - set(names)
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+        selected = [
+            col for col in header["columns"] if not columns or col["name"] in columns
+        ]
+        start = min(offset, total)
+        count = total - start if limit is None else min(limit, total - start)
+    except Exception:
+        reader.close()
+        raise
+
+    out_columns = []
+    out_offset = 0
+    for col in selected:
+        nbytes = count * np.dtype(col["dtype"]).itemsize
+        out_columns.append({**col, "offset": out_offset, "nbytes": nbytes})
+        out_offset += nbytes + _padding(nbytes)
+    out_header = {
+        **header,
+        "length": count,
+        "total_length": total,
+        "row_offset": start,
+        "shuffle": False,
+        "columns": out_columns,
+    }
+    if "blocks" in header:
+        # Clip the block bounding boxes to the projected rows
+        out_header["blocks"] = [
+            {
+                **block,
+                "row": max(block["row"] - start, 0),
+                "rows": min(block["row"] + block["rows"], start + count)
+                - max(block["row"], start),
+            }
+            for block in header["blocks"]
+            if block["row"] < start + count and block["row"] + block["rows"] > start
+        ]
+    out_header = msgpack.packb(out_header, use_bin_type=True)
+    preamble_size = len(COLUMNAR_MAGIC) + 4 + len(out_header)
+    size = preamble_size + _padding(preamble_size) + out_offset
+
+    def iter_content():
+        try:
+            preamble = io.BytesIO()
+            _write_preamble(preamble, COLUMNAR_MAGIC, out_header, ALIGNMENT)
+            yield preamble.getvalue()
+            for col in selected:
+                itemsize = np.dtype(col["dtype"]).itemsize
+                col_start = data_start + col["offset"]
+                if header.get("shuffle"):
+                    yield from _iter_unshuffled(
+                        reader, col_start, total, start, count, itemsize
+                    )
+                else:
+                    yield from reader.iter_range(
+                        col_start + start * itemsize, count * itemsize
+                    )
+                yield b"\0" * _padding(count * itemsize)
+        finally:
+            reader.close()
+
+    return size, iter_content()
+
+
+def arrow_projection(
+    path: str,
+    columns: Optional[List[str]] = None,
+    offset: int = 0,
+    limit: Optional[int] = None,
+) -> tuple:
+    """Project a memory-mapped Arrow IPC artifact onto columns and a row range.
+
+    The projection is streamed by the polars engine into an anonymous
+    temporary file rather than collected, so the process serving it never
+    holds the projected rows in memory.
+
+    Returns the size of the projection in bytes and an iterator over its content.
+    """
+    lazy = pl.scan_ipc(path, memory_map=True)
+    names = lazy.collect_schema().names()
+    unknown = set(columns or []) - set(names)
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+    if columns:
+        lazy = lazy.select([name for name in names if name in columns])
+    f = tempfile.TemporaryFile()
+    try:
+        lazy.slice(offset, limit).sink_ipc(f)
+        size = f.tell()
+        f.seek(0)
+    except Exception:
+        f.close()
+        raise
+
+    def iter_content():
+        with f:
+            while chunk := f.read(READ_SIZE):
+                yield chunk
+
+    return size, iter_content()
@@ -0,0 +1,335 @@
+import json
+import struct
+
+import msgpack
+import numpy as np
+import polars as pl
+
+from api.models import FileRead, ProcessOptions
+from src.compression import byte_shuffle, open_writer
+from src.morton import block_bounds, morton_sort
+
+COLUMNAR_MAGIC = b"AVCOL\x00\x01\x00"
+VERTEX_MAGIC = b"AVVTX\x00\x01\x00"
+ALIGNMENT = 64
+VERTEX_ALIGNMENT = 16
+CHUNK_ROWS = 1 << 20
+ARROW_BATCH_ROWS = 1 << 16
+
+
+def _padding(position: int, alignment: int = ALIGNMENT) -> int:
+    return -position % alignment
+
+
+def _write_preamble(f, magic: bytes, header: bytes, alignment: int) -> None:
+    """Write magic, header length and header, padded to the data alignment."""
+    f.write(magic)
+    f.write(struct.pack("<I", len(header)))
+    f.write(header)
+    f.write(b"\0" * _padding(len(magic) + 4 + len(header), alignment))
+
+
+def write_msgpack(
+    df: pl.DataFrame, path: str, compression: str = "none", blocks: list = None
+) -> None:
+    """Legacy row-wise layout: {"columns": [...], "rows": [[...], ...]}.
+
+    Spatially ordered output adds the per-block bounding boxes as "blocks".
+    """
+    data_dict = {
+        "columns": df.columns,
+        "rows": df.to_numpy().tolist(),
+    }
+    if blocks is not None:
+        data_dict["blocks"] = blocks
+    with open_writer(path, compression) as f:
+        f.write(msgpack.packb(data_dict, use_bin_type=True))
+
+
+def column_stats(values: np.ndarray) -> tuple:
+    finite = values[np.isfinite(values)]
+    if finite.size == 0:
+        return None, None
+    return float(finite.min()), float(finite.max())
+
+
+QUANTIZED_DTYPES = {"float16": "<f2", "uint16": "<u2", "uint8": "<u1"}
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+def quantize(values: np.ndarray, mode: str, col_min, col_max) -> tuple:
+    """Quantize a float32 column and measure the error it introduces.
+
+    "float16" casts the values; a column whose finite values exceed the
+    float16 range is kept as float32 instead of overflowing to infinity.
+    "uint16"/"uint8" map [min, max] linearly onto the integer range, so that
+    value = stored * scale + offset. Non-finite values are clamped into the
+    range. Returns the quantized array, its scale and offset, and the max-abs
+    and RMS error over finite values.
+    """
+    if mode == "float16" and (
+        col_min is not None and max(-col_min, col_max) > FLOAT16_MAX
+    ):
+        quantized = restored = values
+        scale, offset = 1.0, 0.0
+    elif mode == "float16":
+        quantized = values.astype("<f2")
+        restored = quantized.astype("<f4")
+        scale, offset = 1.0, 0.0
+    else:
+        dtype = np.dtype(QUANTIZED_DTYPES[mode])
+        levels = np.iinfo(dtype).max
+        offset = col_min if col_min is not None else 0.0
+        span = (col_max - col_min) if col_min is not None else 0.0
+        scale = span / levels if span > 0 else 1.0
+        clamped = np.nan_to_num(values, nan=offset, posinf=offset + span, neginf=offset)
+        quantized = np.clip(np.rint((clamped - offset) / scale), 0, levels).astype(
+            dtype
+        )
+        restored = quantized * np.float32(scale) + np.float32(offset)
+
+    finite = np.isfinite(values)
+    error = np.abs(
+        restored[finite].astype(np.float64) - values[finite].astype(np.float64)
+    )
+    errors = {
+        "max_abs_error": float(error.max()) if error.size else 0.0,
+        "rms_error": float(np.sqrt(np.mean(np.square(error)))) if error.size else 0.0,
+    }
+    return quantized, float(scale), float(offset), errors
+
+
+def columnar_layout(
+    df: pl.DataFrame,
+    shuffle: bool = False,
+    quantization: str = "none",
+    blocks: list = None,
+) -> tuple:
+    """Build the header and column buffers of a columnar artifact.
+
+    Returns the msgpack header, the column arrays and the quantization report.
+    """
+    columns = []
+    arrays = []
+    report = {}
+    data_offset = 0
+    for name in df.columns:
+        values = np.ascontiguousarray(df[name].cast(pl.Float32).to_numpy(), dtype="<f4")
+        col_min, col_max = column_stats(values)
+        column = {"name": name, "min": col_min, "max": col_max}
+        if quantization != "none":
+            values, scale, offset, report[name] = quantize(
+                values, quantization, col_min, col_max
+            )
+            column["quantization"] = {"scale": scale, "offset": offset}
+        column.update(dtype=values.dtype.str, offset=data_offset, nbytes=values.nbytes)
+        columns.append(column)
+        arrays.append(values)
+        data_offset += values.nbytes + _padding(values.nbytes)
+
+    header = {
+        "format": "columnar",
+        "version": 1,
+        "length": df.height,
+        "shuffle": shuffle,
+        "columns": columns,
+    }
+    if blocks is not None:
+        header["blocks"] = blocks
+    return msgpack.packb(header, use_bin_type=True), arrays, report
+
+
+def write_columnar_data(f, header: bytes, arrays: list, shuffle: bool = False) -> int:
+    """Write a columnar artifact to an open file and return its size in bytes."""
+    size = len(COLUMNAR_MAGIC) + 4 + len(header)
+    size += _padding(size)
+    _write_preamble(f, COLUMNAR_MAGIC, header, ALIGNMENT)
+    for values in arrays:
+        f.write(byte_shuffle(values) if shuffle else memoryview(values))
+        f.write(b"\0" * _padding(values.nbytes))
+        size += values.nbytes + _padding(values.nbytes)
+    return size
+
+
+def write_columnar(
+    df: pl.DataFrame,
+    path: str,
+    compression: str = "none",
+    quantization: str = "none",
+    blocks: list = None,
+) -> dict:
+    """Columnar layout with one contiguous little-endian buffer per column.
+
+    File layout:
+        magic (8 bytes) | header length (uint32 LE) | msgpack header | padding
+        | column buffers, each starting on a 64-byte boundary
+
+    The header holds the row count and, per column, its name, dtype, byte
+    offset (relative to the start of the data section), byte length and
+    finite min/max. Columns are float32 unless quantized, in which case the
+    column also records {"quantization": {"scale", "offset"}}. When the
+    artifact is compressed, the column buffers are byte-shuffled first and
+    the header sets "shuffle". Spatially ordered output lists the bounding
+    box of each block of rows under "blocks".
+
+    Returns the per-column quantization error report (empty if unquantized).
+    """
+    shuffle = compression != "none"
+    header, arrays, report = columnar_layout(df, shuffle, quantization, blocks)
+    with open_writer(path, compression) as f:
+        write_columnar_data(f, header, arrays, shuffle)
+    return report
+
+
+def axis_columns(df: pl.DataFrame, file_config: FileRead) -> list:
+    """Columns flagged as x/y/z axes, falling back to columns named x, y and z."""
+    axes = []
+    for flag, default in (("x_axis", "x"), ("y_axis", "y"), ("z_axis", "z")):
+        name = next(
+            (
+                var.var_name
+                for var in file_config.variables
+                if getattr(var, flag) and var.var_name in df.columns
+            ),
+            default,
+        )
+        if name not in df.columns:
+            raise ValueError(f"No {flag} variable selected for the vertex output")
+        axes.append(name)
+    return axes
+
+
+def write_vertex(
+    df: pl.DataFrame,
+    path: str,
+    axes: list,
+    compression: str = "none",
+    blocks: list = None,
+) -> None:
+    """Interleaved vertex buffer ready for a single GPU upload.
+
+    File layout:
+        magic (8 bytes) | descriptor length (uint32 LE) | JSON descriptor | padding
+        | vertices, starting on a 16-byte boundary
+
+    Each vertex holds the position as float32x3 followed by one float32 per
+    remaining column, padded to a 16-byte stride. The descriptor gives the
+    vertex count, stride, per-attribute offsets and value ranges, the
+    position bounds and, for spatially ordered output, per-block bounds.
+    """
+    attributes = [name for name in df.columns if name not in axes]
+    components = 3 + len(attributes)
+    stride = 4 * components
+    stride += _padding(stride, VERTEX_ALIGNMENT)
+
+    stats = {}
+    for name in df.columns:
+        col = df[name].cast(pl.Float32)
+        col = col.filter(col.is_finite())
+        stats[name] = (float(col.min()), float(col.max())) if len(col) else (None, None)
+
+    descriptor = {
+        "format": "vertex",
+        "version": 1,
+        "count": df.height,
+        "stride": stride,
+        "attributes": [
+            {
+                "name": "position",
+                "type": "float32",
+                "components": 3,
+                "offset": 0,
+                "source": axes,
+            }
+        ]
+        + [
+            {
+                "name": name,
+                "type": "float32",
+                "components": 1,
+                "offset": 4 * (3 + i),
+                "min": stats[name][0],
+                "max": stats[name][1],
+            }
+            for i, name in enumerate(attributes)
+        ],
+        "bounds": {
+            "min": [stats[name][0] for name in axes],
+            "max": [stats[name][1] for name in axes],
+        },
+    }
+    if blocks is not None:
+        descriptor["blocks"] = blocks
+    # Browsers' JSON.parse rejects NaN and Infinity
+    descriptor_bytes = json.dumps(descriptor, allow_nan=False).encode()
+
+    with open_writer(path, compression) as f:
+        _write_preamble(f, VERTEX_MAGIC, descriptor_bytes, VERTEX_ALIGNMENT)
+        for offset in range(0, df.height, CHUNK_ROWS):
+            chunk = df.slice(offset, CHUNK_ROWS)
+            vertices = np.zeros((chunk.height, stride // 4), dtype="<f4")
+            for i, name in enumerate(axes + attributes):
+                vertices[:, i] = chunk[name].cast(pl.Float32).to_numpy()
+            f.write(memoryview(vertices))
+
+
+def write_arrow(
+    df: pl.DataFrame,
+    path: str,
+    compression: str = "none",
+    batch_size: int = ARROW_BATCH_ROWS,
+) -> None:
+    """Arrow IPC file (Feather v2) with one record batch per batch_size rows.
+
+    zstd/lz4 compress the buffers inside the IPC file, so the artifact stays
+    a regular Arrow file that readers can open with memory mapping.
+    """
+    batches = pl.concat(
+        [df.slice(offset, batch_size) for offset in range(0, df.height, batch_size)]
+        or [df],
+        rechunk=False,
+    )
+    batches.write_ipc(
+        path, compression="uncompressed" if compression == "none" else compression
+    )
+
+
+def write_output(
+    df: pl.DataFrame, path: str, options: ProcessOptions, file_config: FileRead
+) -> dict:
+    """Write a processed frame in the requested output format.
+
+    With spatial_order "morton", rows are first sorted along the Morton
+    curve of the axis columns and the bounds of each block of rows are
+    recorded in the header.
+
+    Returns a report to store on the job (quantization errors per column,
+    octree size).
+    """
+    blocks = None
+    if options.spatial_order == "morton":
+        axes = axis_columns(df, file_config)
+        df = morton_sort(df, axes)
+        blocks = block_bounds(df, axes)
+
+    if options.output_format == "octree":
+        from src.octree import write_octree
+
+        return write_octree(df, path, axis_columns(df, file_config))
+    elif options.output_format == "arrow":
+        write_arrow(
+            df, path, options.compression, options.batch_size or ARROW_BATCH_ROWS
+        )
+    elif options.output_format == "vertex":
+        write_vertex(
+            df, path, axis_columns(df, file_config), options.compression, blocks
+        )
+    elif options.output_format == "columnar":
+        quantization = write_columnar(
+            df, path, options.compression, options.quantization, blocks
+        )
+        if quantization:
+            return {"quantization": quantization}
+    else:
+        write_msgpack(df, path, options.compression, blocks)
+    return {}
@@ -1,9 +1,12 @@
 import pytest
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import Session, SQLModel, create_engine, delete
 
 from api.deps import get_session
+from api.executor import JobExecutor
 from api.main import app
+from api.models import ProcessJob
 
 TEST_DATABASE_URL = "sqlite:///test.db"
 
@@ -16,6 +19,29 @@ def session_fixture():
         yield session
 
 
+@pytest.fixture
+def session_factory(session: Session):
+    """Sessions on the test database, for code that opens its own."""
+    return sessionmaker(class_=Session, bind=session.get_bind())
+
+
+@pytest.fixture
+def empty_queue(session: Session):
+    """Remove the jobs left by earlier tests."""
+    session.exec(delete(ProcessJob))
+    session.commit()
+
+
+@pytest.fixture
+def make_executor(session_factory):
+    """Build job executors on the test database, without starting them."""
+
+    def make(**kwargs) -> JobExecutor:
+        return JobExecutor(session_factory=session_factory, **kwargs)
+
+    return make
+
+
 @pytest.fixture(name="client")
 def client_fixture(session: Session):
     def get_session_override():
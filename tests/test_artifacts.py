@@ -0,0 +1,331 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import Session, delete, select
+
+from api.models import (
+    Artifact,
+    File,
+    FileProjectLink,
+    FileRead,
+    FileUpdate,
+    ProcessJob,
+    ProcessOptions,
+    Project,
+    ProjectDuplicate,
+    Variable,
+    VariableRead,
+)
+from api.services import FileService, ProcessJobService, ProjectService
+from api.services import artifact as artifact_module
+from api.services.artifact import ArtifactService
+from src.cache import file_fingerprint
+
+
+@pytest.fixture
+def artifact_dirs(session: Session, tmp_path, monkeypatch):
+    """Point the artifact service at empty cache directories."""
+    dirs = {
+        name: tmp_path / name
+        for name in ("DATA_DIR", "ARTIFACTS_DIR", "RAW_CACHE_DIR", "PARTIAL_DIR")
+    }
+    for name, path in dirs.items():
+        path.mkdir()
+        monkeypatch.setattr(artifact_module, name, str(path))
+    # Artifacts registered by earlier tests would count towards the budget
+    session.exec(delete(Artifact))
+    session.commit()
+    return dirs
+
+
+def add_project_file(session: Session, path: str, *projects: str) -> tuple:
+    """A file linked to new projects; returns the file and the projects."""
+    file = File(type="hdf5", name=os.path.basename(path), path=path)
+    session.add(file)
+    created = [Project(name=name) for name in projects]
+    session.add_all(created)
+    session.commit()
+    session.add(Variable(file_id=file.id, var_name="x", unit="", thr_min=0, thr_max=1))
+    for project in created:
+        session.add(FileProjectLink(project_id=project.id, file_id=file.id))
+    session.commit()
+    return file, created
+
+
+def write_artifact(session: Session, key: str, size: int = 100, **fields) -> Artifact:
+    path = ArtifactService.artifact_path(key, ProcessOptions())
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    artifact = ArtifactService(session).register_artifact(key, path, "msgpack")
+    for name, value in fields.items():
+        setattr(artifact, name, value)
+    session.commit()
+    return artifact
+
+
+def age(path, seconds: float = 3600) -> None:
+    """Backdate a file so the orphan sweep does not treat it as in progress."""
+    timestamp = time.time() - seconds
+    os.utime(path, (timestamp, timestamp))
+
+
+class TestArtifacts:
+    """Test content-addressed artifact sharing, eviction and sweeping"""
+
+    def test_reference_counting(self, session: Session, artifact_dirs):
+        """Links count references; the last release deletes the artifact"""
+        file, (first, second) = add_project_file(
+            session, "refcount.hdf5", "first", "second"
+        )
+        file_service = FileService(session)
+        key = ArtifactService.artifact_key(
+            file_service.get_file(first.id, file.id), ProcessOptions()
+        )
+        artifact = write_artifact(session, key)
+        path = artifact.path
+        artifact_service = ArtifactService(session)
+        job_service = ProcessJobService(session)
+
+        # Processing identical settings links the cached artifact
+        for project in (first, second):
+            job = job_service.get_job(
+                job_service.start_file_processing(project.id, file.id)
+            )
+            assert (job.status, job.result_path) == ("done", path)
+        assert artifact_service.reference_count(key) == 2
+
+        # Changing the settings releases the previous artifact
+        file_data = file_service.get_file(first.id, file.id)
+        update = FileUpdate.model_validate(
+            {**file_data.model_dump(), "downsampling": 0.5}
+        )
+        file_service.update_file(first.id, file.id, update)
+        session.commit()
+        assert artifact_service.reference_count(key) == 1
+        assert not file_service.get_file(first.id, file.id).processed
+
+        update = FileUpdate.model_validate(file_data.model_dump())
+        file_service.update_file(first.id, file.id, update)
+        job_service.start_file_processing(first.id, file.id)
+        assert artifact_service.reference_count(key) == 2
+
+        # A shared artifact survives the deletion of one project
+        ProjectService(session).delete_project(first.id)
+        assert artifact_service.reference_count(key) == 1
+        assert os.path.exists(path)
+        assert file_service.get_file(second.id, file.id).processed_path == path
+
+        file_service.remove_files_from_project(second.id, [file.path])
+        session.commit()
+        assert artifact_service.reference_count(key) == 0
+        assert not os.path.exists(path)
+        assert session.get(Artifact, key) is None
+
+    def test_concurrent_links_release_replaced_artifacts(
+        self, session: Session, artifact_dirs
+    ):
+        """Workers linking the same project file release what they replaced"""
+        file, (project,) = add_project_file(session, "race.hdf5", "race")
+        for key in ("race-old", "race-first", "race-second"):
+            write_artifact(session, key)
+        ArtifactService(session).link_artifact(
+            project.id, file.id, session.get(Artifact, "race-old")
+        )
+        session.commit()
+
+        engine = session.get_bind()
+        first, second = Session(engine), Session(engine)
+        ArtifactService(first).link_artifact(
+            project.id, file.id, first.get(Artifact, "race-first")
+        )
+
+        def link_second():
+            ArtifactService(second).link_artifact(
+                project.id, file.id, second.get(Artifact, "race-second")
+            )
+            second.commit()
+
+        thread = threading.Thread(target=link_second)
+        thread.start()
+        # The second worker waits for the first one's link
+        thread.join(0.2)
+        assert thread.is_alive()
+        first.commit()
+        thread.join()
+        first.close()
+        second.close()
+
+        session.expire_all()
+        assert session.get(Artifact, "race-old") is None
+        assert session.get(Artifact, "race-first") is None
+        assert ArtifactService(session).reference_count("race-second") == 1
+
+    def test_key_ignores_thresholds_that_do_not_filter(
+        self, session: Session, artifact_dirs, tmp_path
+    ):
+        """Settings that produce the same output share an artifact key"""
+        source = tmp_path / "key.hdf5"
+        source.write_bytes(b"source")
+
+        def key(**selection):
+            variable = VariableRead(
+                var_name="x", unit="", thr_min=-1, thr_max=1, selected=True
+            )
+            file_data = FileRead(
+                id=1,
+                type="hdf5",
+                name="key",
+                path=str(source),
+                variables=[variable.model_copy(update=selection)],
+            )
+            return ArtifactService.artifact_key(file_data, ProcessOptions())
+
+        unset = key()
+        assert key(thr_min_sel=0, thr_max_sel=1) == unset
+        assert key(thr_min_sel=-1, thr_max_sel=None) == unset
+        assert key(thr_min_sel=-0.5, thr_max_sel=0.5) != unset
+
+    def test_duplicate_project_shares_artifacts(self, session: Session, artifact_dirs):
+        """Duplicates reference the original's artifacts instead of copying them"""
+        file, (original,) = add_project_file(session, "duplicate.hdf5", "original")
+        artifact = write_artifact(session, "duplicate-key")
+        artifact_service = ArtifactService(session)
+        artifact_service.link_artifact(original.id, file.id, artifact)
+        session.commit()
+
+        project_service = ProjectService(session)
+        duplicate = project_service.duplicate_project(
+            original.id, ProjectDuplicate(name="copy", description="")
+        )
+        (copied,) = duplicate.files
+        assert (copied.processed, copied.processed_path) == (True, artifact.path)
+        assert artifact_service.reference_count("duplicate-key") == 2
+        assert os.listdir(artifact_dirs["ARTIFACTS_DIR"]) == [
+            os.path.basename(artifact.path)
+        ]
+
+        project_service.delete_project(original.id)
+        assert artifact_service.reference_count("duplicate-key") == 1
+        assert os.path.exists(artifact.path)
+        assert project_service.get_project(duplicate.id).files[0].processed
+
+    def test_lru_eviction(self, session: Session, artifact_dirs):
+        """Least recently used artifacts are evicted until the budget fits"""
+        file, (project,) = add_project_file(session, "lru.hdf5", "lru")
+        now = datetime.utcnow()
+        artifacts = {
+            key: write_artifact(
+                session, key, last_accessed=now - timedelta(hours=hours)
+            ).path
+            for key, hours in (("lru-a", 3), ("lru-b", 2), ("lru-c", 1))
+        }
+        artifact_service = ArtifactService(session)
+        link = artifact_service.link_artifact(
+            project.id, file.id, session.get(Artifact, "lru-b")
+        )
+        session.commit()
+        # Reading the oldest artifact moves it to the back of the order
+        artifact_service.touch_artifact(artifacts["lru-a"])
+
+        artifact_service.enforce_budget(budget=200)
+        session.commit()
+        assert {artifact.key for artifact in session.exec(select(Artifact))} >= {
+            "lru-a",
+            "lru-c",
+        }
+        assert session.get(Artifact, "lru-b") is None
+        assert not os.path.exists(artifacts["lru-b"])
+        session.refresh(link)
+        assert (link.processed, link.artifact_key) == (False, None)
+
+        # The artifact just written is kept even when it alone exceeds the budget
+        artifact_service.enforce_budget(budget=50, keep="lru-a")
+        session.commit()
+        assert session.get(Artifact, "lru-c") is None
+        assert os.path.exists(artifacts["lru-a"])
+
+    def test_raw_cache_shares_budget(self, session: Session, artifact_dirs, tmp_path):
+        """Raw cache entries count towards the budget and are evicted by age"""
+        raw_dir = artifact_dirs["RAW_CACHE_DIR"]
+        entries = {}
+        for name, hours in (("busy", 4), ("old", 3), ("new", 1)):
+            source = tmp_path / f"{name}.hdf5"
+            source.write_bytes(b"source")
+            entry = raw_dir / file_fingerprint(str(source))
+            entry.mkdir()
+            (entry / "x.arrow").write_bytes(b"\0" * 100)
+            age(entry, hours * 3600)
+            entries[name] = (str(source), entry)
+        artifact = write_artifact(
+            session,
+            "raw-artifact",
+            last_accessed=datetime.utcnow() - timedelta(hours=2),
+        )
+        # The oldest entry belongs to a file that is being processed
+        payload = {"file": {"path": entries["busy"][0]}}
+        session.add(ProcessJob(status="processing", payload=payload))
+        session.commit()
+
+        artifact_service = ArtifactService(session)
+        artifact_service.enforce_budget(budget=300)
+        session.commit()
+        assert not entries["old"][1].exists()
+        assert entries["busy"][1].exists() and entries["new"][1].exists()
+        assert os.path.exists(artifact.path)
+
+        artifact_service.enforce_budget(budget=200)
+        session.commit()
+        assert session.get(Artifact, "raw-artifact") is None
+        assert entries["new"][1].exists()
+
+    def test_sweep_orphans(self, session: Session, artifact_dirs):
+        """The sweep removes what no artifact, project file or job refers to"""
+        file, (project,) = add_project_file(session, "sweep.hdf5", "sweep")
+        artifacts_dir = artifact_dirs["ARTIFACTS_DIR"]
+
+        # A registered artifact whose file disappeared is evicted
+        missing = write_artifact(session, "sweep-missing")
+        link = ArtifactService(session).link_artifact(project.id, file.id, missing)
+        session.commit()
+        os.remove(missing.path)
+        kept = write_artifact(session, "sweep-kept").path
+        age(kept)
+
+        # Unregistered files are removed unless they are being written
+        stale_file = artifacts_dir / "stale.columnar.tmp"
+        fresh_file = artifacts_dir / "fresh.columnar.tmp"
+        legacy = artifact_dirs["DATA_DIR"] / "project_1_file_2_processed.msgpack"
+        for path in (stale_file, legacy):
+            path.write_bytes(b"x")
+            age(path)
+
+        # Raw cache entries of unknown files and partial results of
+        # finished jobs are removed
+        known_cache = artifact_dirs["RAW_CACHE_DIR"] / file_fingerprint(file.path)
+        unknown_cache = artifact_dirs["RAW_CACHE_DIR"] / "unknown"
+        job = ProcessJob(status="pending")
+        session.add(job)
+        session.commit()
+        running = artifact_dirs["PARTIAL_DIR"] / str(job.id)
+        finished = artifact_dirs["PARTIAL_DIR"] / "999999"
+        for path in (known_cache, unknown_cache, running, finished):
+            path.mkdir()
+            age(path)
+
+        service = ArtifactService(session)
+        fresh_file.write_bytes(b"x")
+        os.utime(fresh_file, (time.time() + 60, time.time() + 60))
+        service.sweep_orphans()
+        session.commit()
+
+        assert session.get(Artifact, "sweep-missing") is None
+        session.refresh(link)
+        assert not link.processed
+        assert os.path.exists(kept)
+        assert not stale_file.exists() and not legacy.exists()
+        assert fresh_file.exists()
+        assert known_cache.exists() and not unknown_cache.exists()
+        assert running.exists() and not finished.exists()
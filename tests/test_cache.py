@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import polars as pl
+
+from src import cache
+
+
+class TestRawCache:
+    """Test the cache of converted source variables"""
+
+    def test_raw_cache_roundtrip(self, tmp_path, monkeypatch):
+        """Cached variables are read back memory-mapped with their dtype"""
+        monkeypatch.setattr(cache, "RAW_CACHE_DIR", str(tmp_path / "raw"))
+        source = tmp_path / "sim.hdf5"
+        source.write_bytes(b"source")
+        path = str(source)
+        assert cache.read_cached_variable(path, "mass") is None
+
+        series = pl.Series("mass", np.arange(5, dtype="f4"))
+        cache.write_cached_variable(path, series)
+        cached = cache.read_cached_variable(path, "mass")
+        assert cached.name == "mass"
+        assert cached.equals(series)
+        assert cache.read_cached_variable(path, "other") is None
+
+        monkeypatch.setattr(cache, "RAW_CACHE_ENABLED", False)
+        assert cache.read_cached_variable(path, "mass") is None
+
+    def test_raw_cache_invalidated_by_source_changes(self, tmp_path, monkeypatch):
+        """Changing the size or modification time of a source misses the cache"""
+        monkeypatch.setattr(cache, "RAW_CACHE_DIR", str(tmp_path / "raw"))
+        source = tmp_path / "sim.hdf5"
+        source.write_bytes(b"source")
+        path = str(source)
+        cache.write_cached_variable(path, pl.Series("mass", [1.0]))
+        fingerprint = cache.file_fingerprint(path)
+        # The fingerprint does not depend on how the path is spelled
+        assert cache.file_fingerprint(str(tmp_path / "." / "sim.hdf5")) == fingerprint
+
+        stat = source.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        assert cache.file_fingerprint(path) != fingerprint
+        assert cache.read_cached_variable(path, "mass") is None
+
+        cache.write_cached_variable(path, pl.Series("mass", [2.0]))
+        mtime = source.stat().st_mtime_ns
+        source.write_bytes(b"source, rewritten")
+        os.utime(path, ns=(mtime, mtime))
+        assert cache.read_cached_variable(path, "mass") is None
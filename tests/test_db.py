@@ -0,0 +1,44 @@
+from sqlalchemy import inspect, text
+from sqlmodel import Session, create_engine, select
+
+from api.db import upgrade_schema
+from api.models import ProcessJob
+
+
+class TestSchemaUpgrade:
+    """Test upgrading databases written by earlier versions"""
+
+    def test_upgrade_adds_missing_columns(self, tmp_path):
+        """Columns and indexes added to the models are added to existing tables"""
+        engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    "CREATE TABLE processjob (id INTEGER PRIMARY KEY, "
+                    "project_id INTEGER, file_id INTEGER, status VARCHAR NOT NULL, "
+                    "progress FLOAT NOT NULL, result_path VARCHAR, error VARCHAR, "
+                    "created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL)"
+                )
+            )
+            connection.execute(
+                text(
+                    "INSERT INTO processjob (status, progress, created_at, updated_at) "
+                    "VALUES ('done', 1.0, '2024-01-01', '2024-01-01')"
+                )
+            )
+
+        upgrade_schema(engine)
+        # Upgrading an up-to-date database changes nothing
+        upgrade_schema(engine)
+
+        inspector = inspect(engine)
+        columns = {column["name"] for column in inspector.get_columns("processjob")}
+        assert columns == set(ProcessJob.__table__.columns.keys())
+        assert "ix_processjob_active_dedup_key" in {
+            index["name"] for index in inspector.get_indexes("processjob")
+        }
+        with Session(engine) as session:
+            job = session.exec(select(ProcessJob)).one()
+            assert (job.kind, job.priority, job.attempts) == ("file", 0, 0)
+            assert job.output_format == "msgpack"
+            assert job.payload is None
@@ -0,0 +1,533 @@
+import asyncio
+import json
+from multiprocessing import Array
+from threading import Event
+
+import msgpack
+import numpy as np
+import pytest
+from astropy.io import fits
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from api import executor as executor_module
+from api.events import broadcaster, job_event
+from api.executor import (
+    JOB_STAGES,
+    MAX_ATTEMPTS,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_SPECULATIVE,
+    STATE_SIZE,
+    STOP,
+    _run_worker,
+    estimate_job_memory,
+    executor,
+    thread_budget,
+)
+from api.models import File, FileProjectLink, FileUpdate, ProcessJob, Project, Variable
+from api.services import FileService, ProcessJobService
+from api.services import artifact as artifact_module
+from api.services import job as job_module
+from api.services.job import JobCancelToken, JobProgress
+from src import cache, chunks, processors
+from src.processors import ProcessingCancelled
+
+
+@pytest.mark.usefixtures("empty_queue")
+class TestJobQueue:
+    """Test the persistent job queue"""
+
+    def test_fifo_claims_and_queue_position(self, session: Session, make_executor):
+        """Pending jobs are claimed oldest first and report their queue position"""
+        jobs = [ProcessJob(status="pending") for _ in range(3)]
+        session.add_all(jobs)
+        session.commit()
+        for job in jobs:
+            session.refresh(job)
+
+        service = ProcessJobService(session)
+        assert [service.get_job_progress(job.id)["queue_position"] for job in jobs] == [
+            1,
+            2,
+            3,
+        ]
+
+        job_executor = make_executor()
+        assert job_executor.claim_next_job() == jobs[0].id
+        assert job_executor.claim_next_job() == jobs[1].id
+
+        session.expire_all()
+        progress = service.get_job_progress(jobs[0].id)
+        assert progress["status"] == "processing"
+        assert progress["queue_position"] is None
+        assert service.get_job_progress(jobs[2].id)["queue_position"] == 1
+
+        assert job_executor.claim_next_job() == jobs[2].id
+        assert job_executor.claim_next_job() is None
+
+    def test_memory_admission(self, session: Session, make_executor):
+        """Jobs are admitted while their calibrated estimates fit the budget"""
+        payload = {
+            "file": {"type": "fits", "total_points": 10**8, "variables": []},
+            "options": {"output_format": "columnar"},
+        }
+        estimate = estimate_job_memory(payload)
+        jobs = [
+            ProcessJob(status="pending", output_format="columnar", payload=payload)
+            for _ in range(2)
+        ]
+        session.add_all(jobs)
+        session.commit()
+        for job in jobs:
+            session.refresh(job)
+
+        job_executor = make_executor(memory_budget=estimate)
+        # The head of the queue runs alone even if it exceeds the budget
+        assert job_executor.claim_next_job() == jobs[0].id
+        assert job_executor.claim_next_job() is None
+
+        # A finished job that peaked at twice its estimate doubles the next one
+        job_executor.reserved.clear()
+        session.expire_all()
+        finished = session.get(ProcessJob, jobs[0].id)
+        finished.status = "done"
+        finished.peak_memory = 2 * finished.memory_estimate
+        session.commit()
+        assert job_executor.calibration(session, "columnar") == 2.0
+        assert job_executor.claim_next_job() == jobs[1].id
+        assert job_executor.reserved[jobs[1].id] == 2 * estimate
+
+    def test_active_jobs_are_deduplicated(self, session: Session):
+        """Only one queued or running job exists per request key"""
+        service = ProcessJobService(session)
+        key = service.job_key(1, 1, "artifact")
+        assert key != service.job_key(1, 2, "artifact")
+
+        job = ProcessJob(status="pending", dedup_key=key)
+        session.add(job)
+        session.commit()
+        assert service.get_active_job(key).id == job.id
+
+        session.add(ProcessJob(status="pending", dedup_key=key))
+        with pytest.raises(IntegrityError):
+            session.commit()
+        session.rollback()
+
+        # Finished jobs free the key for the next request
+        job.status = "done"
+        session.add(ProcessJob(status="pending", dedup_key=key))
+        session.commit()
+        assert service.get_active_job(key).id != job.id
+
+    def test_cancel_jobs(self, session: Session, make_executor):
+        """Cancelled jobs are never claimed and finished jobs are left as they are"""
+        jobs = [ProcessJob(status=status) for status in ("pending", "done")]
+        session.add_all(jobs)
+        session.commit()
+        for job in jobs:
+            session.refresh(job)
+
+        job_executor = make_executor()
+        assert job_executor.cancel_jobs(session) == [jobs[0].id]
+        session.commit()
+        session.expire_all()
+        assert [job.status for job in jobs] == ["cancelled", "done"]
+        assert job_executor.claim_next_job() is None
+
+    def test_cancel_token_stops_conversion(self):
+        """The pipeline checks the cancellation token between chunks"""
+        token = Event()
+        token.set()
+        with pytest.raises(ProcessingCancelled):
+            processors.check_cancelled(token)
+        processors.check_cancelled(Event())
+        processors.check_cancelled(None)
+
+    def test_cancel_token_reads_shared_state(
+        self, session: Session, make_executor, monkeypatch
+    ):
+        """The dispatcher signals cancelled workers through their shared state"""
+        job = ProcessJob(status="processing")
+        session.add(job)
+        session.commit()
+        job_executor = make_executor()
+        shared = Array("d", STATE_SIZE)
+        job_executor.workers[job.id] = type(
+            "Worker", (), {"is_alive": lambda _: True}
+        )()
+        job_executor.state[job.id] = shared
+
+        def no_query(job_id):
+            raise AssertionError("the token must not query the database")
+
+        monkeypatch.setattr(ProcessJobService, "_job_status", staticmethod(no_query))
+        token = JobCancelToken(job.id, shared)
+        assert not token.is_set()
+        job_executor.cancel_jobs(session, ProcessJob.id == job.id)
+        session.commit()
+        assert not token.is_set()
+        job_executor._stop_cancelled_workers()
+        assert token.is_set()
+
+    def test_live_progress(self, session: Session, monkeypatch):
+        """Progress is shared in memory and persisted at a bounded rate"""
+        job = ProcessJob(status="processing")
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+
+        persisted = []
+        monkeypatch.setattr(
+            ProcessJobService,
+            "_update_job_progress",
+            staticmethod(lambda job_id, progress: persisted.append(progress)),
+        )
+        shared = Array("d", STATE_SIZE)
+        job_progress = JobProgress(job.id, shared)
+        job_progress.set_stage("converting")
+        for progress in (0.1, 0.2, 0.3):
+            job_progress.update(progress)
+        assert shared[:] == [0.3, 1.0, 0.0]
+        assert persisted == []
+
+        monkeypatch.setattr(job_module, "PROGRESS_PERSIST_INTERVAL", 0.0)
+        job_progress.update(0.4)
+        assert persisted == [0.4]
+
+        monkeypatch.setitem(executor.state, job.id, shared)
+        progress = ProcessJobService(session).get_job_progress(job.id)
+        assert (progress["progress"], progress["stage"]) == (0.4, "converting")
+
+    def test_job_events(self, session: Session):
+        """Event streams get the current state, then the published events"""
+        jobs = [ProcessJob(status=status) for status in ("processing", "done")]
+        session.add_all(jobs)
+        session.commit()
+        running, done = (job.id for job in jobs)
+
+        async def stream():
+            broadcaster.bind(asyncio.get_running_loop())
+            events = ProcessJobService(session).stream_job_events([running, done])
+            received = [await events.__anext__(), await events.__anext__()]
+            broadcaster.publish(job_event(running, "processing", 0.5, type="progress"))
+            broadcaster.publish(job_event(running, "done", 1.0))
+            received += [event async for event in events]
+            return received
+
+        try:
+            received = asyncio.run(stream())
+        finally:
+            broadcaster.bind(None)
+        assert [event.split("\n")[0] for event in received] == [
+            "event: status",
+            "event: status",
+            "event: progress",
+            "event: status",
+        ]
+        assert json.loads(received[3].split("data: ")[1])["status"] == "done"
+        assert not broadcaster.watching(running)
+        assert ProcessJobService(session).stream_job_events([running, 0]) is None
+        assert not broadcaster.watching(running)
+
+    def test_batch_largest_first(self, session: Session, monkeypatch):
+        """A batch queues its files largest first and aggregates their progress"""
+        project = Project(name="batch")
+        session.add(project)
+        session.commit()
+        for points in (10, 30, 20):
+            file = File(type="fits", name=f"f{points}", path=f"{points}.fits")
+            file.total_points = points
+            session.add(file)
+            session.commit()
+            session.add(FileProjectLink(project_id=project.id, file_id=file.id))
+        session.commit()
+
+        def start_file_processing(self, project_id, file_id, options, priority):
+            job = ProcessJob(project_id=project_id, file_id=file_id, priority=priority)
+            self.session.add(job)
+            self.session.commit()
+            return job.id
+
+        monkeypatch.setattr(
+            ProcessJobService, "start_file_processing", start_file_processing
+        )
+        service = ProcessJobService(session)
+        batch = service.start_project_processing(project.id)
+        entries = batch.payload["jobs"]
+        assert [entry["weight"] for entry in entries] == [30, 20, 10]
+        assert entries[0]["job_id"] < entries[1]["job_id"] < entries[2]["job_id"]
+        assert service.get_job_progress(batch.id)["status"] == "pending"
+
+        for entry, status in zip(entries, ("done", "error", "processing")):
+            job = session.get(ProcessJob, entry["job_id"])
+            job.status = status
+            job.progress = 1.0 if status != "processing" else 0.4
+        session.commit()
+        progress = service.get_job_progress(batch.id)
+        assert progress["status"] == "processing"
+        assert progress["progress"] == pytest.approx((30 + 20 + 4) / 60)
+
+        service.cancel_job(batch.id)
+        session.expire_all()
+        assert session.get(ProcessJob, entries[2]["job_id"]).status == "cancelled"
+        assert service.get_job_progress(batch.id)["status"] == "cancelled"
+
+    def test_requeue_interrupted_jobs(self, session: Session, make_executor):
+        """Jobs interrupted by a restart are queued again, up to MAX_ATTEMPTS"""
+        payload = {"file": {"type": "fits", "variables": []}, "options": {}}
+        jobs = [
+            ProcessJob(status="processing", attempts=1, payload=payload),
+            ProcessJob(status="processing", attempts=MAX_ATTEMPTS, payload=payload),
+            # Left by a version that ran jobs without a payload
+            ProcessJob(status="processing"),
+            ProcessJob(status="pending"),
+        ]
+        session.add_all(jobs)
+        session.commit()
+
+        job_executor = make_executor()
+        job_executor.requeue_interrupted_jobs()
+        session.expire_all()
+        assert [job.status for job in jobs] == ["pending", "error", "error", "error"]
+        assert job_executor.claim_next_job() == jobs[0].id
+        assert job_executor.claim_next_job() is None
+        session.expire_all()
+        assert jobs[0].attempts == 2
+
+    def test_priority_and_preemption(self, session: Session, make_executor):
+        """Higher priority jobs are claimed first and preempt converting jobs"""
+        batch = ProcessJob(status="pending", priority=PRIORITY_BATCH)
+        session.add(batch)
+        session.commit()
+        job_executor = make_executor(max_workers=1)
+        assert job_executor.claim_next_job() == batch.id
+        job_executor.workers[batch.id] = type(
+            "Worker", (), {"is_alive": lambda _: True}
+        )()
+        shared = Array("d", STATE_SIZE)
+        shared[:2] = [0.5, JOB_STAGES.index("converting")]
+        job_executor.state[batch.id] = shared
+
+        interactive = [ProcessJob(status="pending") for _ in range(2)]
+        session.add_all(interactive)
+        session.commit()
+        service = ProcessJobService(session)
+        assert service.get_queue_position(interactive[1]) == 2
+
+        job_executor._preempt_for_next_job()
+        session.expire_all()
+        assert (batch.status, batch.attempts) == ("pending", 0)
+        job_progress = JobProgress(batch.id, shared)
+        assert job_progress.preempted()
+        # The worker can no longer start writing its artifact
+        with pytest.raises(ProcessingCancelled):
+            job_progress.set_stage("writing")
+        # The preempted job is not claimed again until its worker exits
+        assert job_executor.claim_next_job() == interactive[0].id
+        assert job_executor.claim_next_job() == interactive[1].id
+        assert job_executor.claim_next_job() is None
+        del job_executor.workers[batch.id]
+        assert job_executor.claim_next_job() == batch.id
+
+    def test_writing_jobs_are_not_preempted(self, session: Session, make_executor):
+        """A job that started writing its artifact is left to finish"""
+        batch = ProcessJob(status="pending", priority=PRIORITY_BATCH)
+        session.add(batch)
+        session.commit()
+        job_executor = make_executor(max_workers=1)
+        assert job_executor.claim_next_job() == batch.id
+        job_executor.workers[batch.id] = type(
+            "Worker", (), {"is_alive": lambda _: True}
+        )()
+        shared = Array("d", STATE_SIZE)
+        job_executor.state[batch.id] = shared
+        JobProgress(batch.id, shared).set_stage("writing")
+
+        session.add(ProcessJob(status="pending"))
+        session.commit()
+        job_executor._preempt_for_next_job()
+        session.expire_all()
+        assert batch.status == "processing"
+        assert shared[STOP] == 0
+
+    def test_speculative_processing(self, session: Session):
+        """New files are queued with a preset at low priority; matching requests join"""
+        project = Project(name="speculative")
+        session.add(project)
+        session.commit()
+        files = [
+            File(type="hdf5", name=name, path=f"{name}.hdf5", total_points=points)
+            for name, points in (("small", 4_000), ("large", 4_000_000))
+        ]
+        session.add_all(files)
+        session.commit()
+        for file in files:
+            for name in ("x", "y", "z", "mass"):
+                session.add(
+                    Variable(
+                        file_id=file.id, var_name=name, unit="", thr_min=0, thr_max=1
+                    )
+                )
+            session.add(FileProjectLink(project_id=project.id, file_id=file.id))
+        session.commit()
+        file = files[0]
+
+        # Files too large to be processed without downsampling are skipped
+        service = ProcessJobService(session)
+        (job_id,) = service.start_speculative_processing(project.id)
+        job = service.get_job(job_id)
+        assert (job.file_id, job.priority) == (file.id, PRIORITY_SPECULATIVE)
+        preset = job.payload["file"]
+        assert preset["downsampling"] == 1.0
+        assert [var["var_name"] for var in preset["variables"] if var["selected"]] == [
+            "x",
+            "y",
+            "z",
+        ]
+        # The project's configuration is not touched
+        file_service = FileService(session)
+        file_data = file_service.get_file(project.id, file.id)
+        assert not any(var.selected for var in file_data.variables)
+        assert service.start_speculative_processing(project.id) == [job_id]
+
+        # Other settings get their own job and leave the speculative one queued
+        update = FileUpdate.model_validate({**preset, "downsampling": 0.5})
+        file_service.update_file(project.id, file.id, update)
+        assert service.start_file_processing(project.id, file.id) != job_id
+        session.refresh(job)
+        assert (job.status, job.priority) == ("pending", PRIORITY_SPECULATIVE)
+
+        # Selecting the axes with the ingestion defaults joins it
+        variables = [
+            {**var.model_dump(), "selected": True, f"{var.var_name}_axis": True}
+            for var in file_data.variables
+            if var.var_name in ("x", "y", "z")
+        ] + [var.model_dump() for var in file_data.variables if var.var_name == "mass"]
+        update = FileUpdate.model_validate(
+            {**file_data.model_dump(), "variables": variables}
+        )
+        file_service.update_file(project.id, file.id, update)
+        assert service.start_file_processing(project.id, file.id) == job_id
+        session.refresh(job)
+        assert job.priority == PRIORITY_INTERACTIVE
+
+    def test_thread_budget(self, session: Session, make_executor):
+        """Jobs split the CPUs between the jobs expected to run together"""
+        assert thread_budget(3, cpus=16) == 5
+        assert thread_budget(32, cpus=16) == 1
+
+        jobs = [ProcessJob(status="pending") for _ in range(3)]
+        session.add_all(jobs)
+        session.commit()
+        job_executor = make_executor(max_workers=2)
+        job_id = job_executor.claim_next_job()
+        assert job_executor.threads[job_id] == thread_budget(2)
+        progress = ProcessJobService(session).get_job_progress(job_id)
+        assert progress["metrics"]["threads"] == thread_budget(2)
+
+
+@pytest.fixture
+def worker_env(session_factory, tmp_path, monkeypatch):
+    """Run workers in-process against the test database and empty caches."""
+    for module in (executor_module, job_module):
+        monkeypatch.setattr(module, "SessionLocal", session_factory)
+    monkeypatch.setattr(artifact_module, "ARTIFACTS_DIR", str(tmp_path / "artifacts"))
+    monkeypatch.setattr(chunks, "PARTIAL_DIR", str(tmp_path / "partial"))
+    monkeypatch.setattr(cache, "RAW_CACHE_DIR", str(tmp_path / "raw"))
+    return tmp_path
+
+
+def add_fits_file(session: Session, path: str) -> tuple:
+    """A FITS file linked to a new project; returns the project and the file."""
+    project = Project(name="worker")
+    file = File(type="fits", name="cube", path=path, total_points=60)
+    session.add_all([project, file])
+    session.commit()
+    for name in ("x", "y", "z", "value"):
+        session.add(
+            Variable(file_id=file.id, var_name=name, unit="", thr_min=0, thr_max=9)
+        )
+    session.add(FileProjectLink(project_id=project.id, file_id=file.id))
+    session.commit()
+    return project, file
+
+
+@pytest.mark.usefixtures("empty_queue")
+class TestJobWorker:
+    """Test processing jobs end to end in the worker entry point"""
+
+    def test_worker_processes_fits_file(
+        self, session: Session, make_executor, worker_env
+    ):
+        """A worker writes, registers and links the artifact and records its peak"""
+        cube = np.zeros((3, 4, 5), dtype="<f4")
+        cube[0, 1, 2] = 1.0
+        cube[2, 3, 4] = 2.0
+        cube[2, 0, 0] = 3.0
+        path = str(worker_env / "cube.fits")
+        fits.PrimaryHDU(cube).writeto(path)
+        project, file = add_fits_file(session, path)
+
+        job_id = ProcessJobService(session).start_file_processing(project.id, file.id)
+        assert make_executor().claim_next_job() == job_id
+        _run_worker(job_id)
+
+        session.expire_all()
+        job = session.get(ProcessJob, job_id)
+        assert (job.status, job.progress, job.error) == ("done", 1.0, None)
+        assert job.peak_memory > 0
+        with open(job.result_path, "rb") as f:
+            result = msgpack.unpackb(f.read())
+        assert result["columns"] == ["x", "y", "z", "value"]
+        # Rows are (x, y, z) = (cube axes 2, 0, 1) and the non-zero value
+        assert sorted(result["rows"]) == [
+            [0, 2, 0, 3.0],
+            [2, 0, 1, 1.0],
+            [4, 2, 3, 2.0],
+        ]
+        file_data = FileService(session).get_file(project.id, file.id)
+        assert (file_data.processed, file_data.processed_path) == (
+            True,
+            job.result_path,
+        )
+        assert chunks.read_chunk_index(job_id) is None
+
+    def test_worker_reports_errors(self, session: Session, make_executor, worker_env):
+        """A job whose conversion fails is marked failed and its worker exits"""
+        project, file = add_fits_file(session, str(worker_env / "missing.fits"))
+
+        job_id = ProcessJobService(session).start_file_processing(project.id, file.id)
+        assert make_executor().claim_next_job() == job_id
+        _run_worker(job_id)
+
+        session.expire_all()
+        job = session.get(ProcessJob, job_id)
+        assert job.status == "error"
+        assert "missing.fits" in job.error
+        assert job.peak_memory > 0
+        assert not FileService(session).get_file(project.id, file.id).processed
+
+    def test_reap_unfinished_jobs(self, session: Session, make_executor, worker_env):
+        """A job still processing after its worker exited is failed"""
+        jobs = [ProcessJob(status="pending") for _ in range(2)]
+        session.add_all(jobs)
+        session.commit()
+        job_executor = make_executor()
+        for job in jobs:
+            assert job_executor.claim_next_job() == job.id
+        # Without a payload the worker records the error itself
+        ProcessJobService(session).run_job(jobs[0].id)
+
+        for job in jobs:
+            job_executor.workers[job.id] = type(
+                "Worker",
+                (),
+                {"is_alive": lambda _: False, "join": lambda _: None, "exitcode": 0},
+            )()
+        job_executor._reap_workers()
+        session.expire_all()
+        assert [job.status for job in jobs] == ["error", "error"]
+        assert jobs[0].error == "Job has no processing settings"
+        assert jobs[1].error == "Worker exited without finishing the job"
+        assert not job_executor.workers
@@ -0,0 +1,124 @@
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from api.responses import artifact_response, file_range_response
+from src.compression import open_writer
+
+DATA = bytes(range(256)) * 64
+
+
+@pytest.fixture
+def artifacts(tmp_path):
+    """A plain and a zstd-compressed artifact holding DATA."""
+    plain = str(tmp_path / "out.msgpack")
+    compressed = str(tmp_path / "out.msgpack.zst")
+    for path, compression in ((plain, "none"), (compressed, "zstd")):
+        with open_writer(path, compression) as f:
+            f.write(DATA)
+    return plain, compressed
+
+
+@pytest.fixture
+def artifact_client(artifacts):
+    plain, compressed = artifacts
+    app = FastAPI()
+    paths = {"plain": plain, "compressed": compressed, "missing": plain + ".gone"}
+
+    @app.get("/artifacts/{name}")
+    def get_artifact(name: str, request: Request):
+        return artifact_response(request, paths[name])
+
+    @app.get("/range/{name}")
+    def get_range(name: str, offset: int, nbytes: int):
+        return file_range_response(paths[name], offset, nbytes)
+
+    return TestClient(app)
+
+
+def get_raw(client: TestClient, url: str, **headers) -> tuple:
+    """Response and body as sent, without content decoding by the client."""
+    with client.stream("GET", url, headers=headers) as response:
+        return response, b"".join(response.iter_raw())
+
+
+class TestArtifactResponses:
+    """Test conditional, range and encoded artifact downloads"""
+
+    def test_full_download_and_etag(self, artifact_client: TestClient):
+        """Downloads carry an ETag and answer a matching If-None-Match with 304"""
+        response = artifact_client.get("/artifacts/plain")
+        assert response.status_code == 200
+        assert response.content == DATA
+        assert response.headers["content-length"] == str(len(DATA))
+        assert response.headers["accept-ranges"] == "bytes"
+        etag = response.headers["etag"]
+
+        response = artifact_client.get(
+            "/artifacts/plain", headers={"if-none-match": etag}
+        )
+        assert response.status_code == 304
+        assert response.content == b""
+
+        assert artifact_client.get("/artifacts/missing").status_code == 404
+
+    def test_range_requests(self, artifact_client: TestClient):
+        """Byte ranges are answered with 206, unsatisfiable ones with 416"""
+        response = artifact_client.get(
+            "/artifacts/plain", headers={"range": "bytes=100-199"}
+        )
+        assert response.status_code == 206
+        assert response.content == DATA[100:200]
+        assert response.headers["content-range"] == f"bytes 100-199/{len(DATA)}"
+
+        response = artifact_client.get(
+            "/artifacts/plain", headers={"range": f"bytes={len(DATA)}-"}
+        )
+        assert response.status_code == 416
+        assert response.headers["content-range"].endswith(f"*/{len(DATA)}")
+
+    def test_stored_encoding(self, artifacts, artifact_client: TestClient):
+        """Clients accepting the coding get the stored bytes with Content-Encoding"""
+        _, compressed = artifacts
+        response, body = get_raw(
+            artifact_client, "/artifacts/compressed", **{"accept-encoding": "zstd"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "zstd"
+        assert response.headers["vary"] == "Accept-Encoding"
+        with open(compressed, "rb") as f:
+            assert body == f.read()
+
+    def test_identity_reencoding(self, artifact_client: TestClient):
+        """Other clients get the decoded bytes under their own validator"""
+        encoded, _ = get_raw(
+            artifact_client, "/artifacts/compressed", **{"accept-encoding": "zstd"}
+        )
+        response, body = get_raw(
+            artifact_client,
+            "/artifacts/compressed",
+            **{"accept-encoding": "gzip, zstd;q=0"},
+        )
+        assert response.status_code == 200
+        assert "content-encoding" not in response.headers
+        assert body == DATA
+        etag = response.headers["etag"]
+        assert etag != encoded.headers["etag"]
+        assert etag.endswith('-identity"')
+
+        response, _ = get_raw(
+            artifact_client,
+            "/artifacts/compressed",
+            **{"accept-encoding": "identity", "if-none-match": etag},
+        )
+        assert response.status_code == 304
+
+    def test_file_range_response(self, artifact_client: TestClient):
+        """Byte ranges of a file are streamed with their length"""
+        response = artifact_client.get("/range/plain?offset=10&nbytes=20")
+        assert response.status_code == 200
+        assert response.content == DATA[10:30]
+        assert response.headers["content-length"] == "20"
+        assert (
+            artifact_client.get("/range/missing?offset=0&nbytes=1").status_code == 404
+        )
@@ -0,0 +1,410 @@
+import json
+import struct
+from contextlib import contextmanager
+
+import msgpack
+import numpy as np
+import polars as pl
+import pytest
+from astropy.io import fits
+
+from api.models import FileRead, VariableRead
+from src import cache, chunks, morton, octree, processors, readers, writers
+from src.compression import iter_decompressed
+
+
+def read_columnar(path: str = None, data: bytes = None):
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    assert data[:8] == writers.COLUMNAR_MAGIC
+    (header_len,) = struct.unpack("<I", data[8:12])
+    header = msgpack.unpackb(data[12 : 12 + header_len])
+    data_start = 12 + header_len
+    data_start += -data_start % writers.ALIGNMENT
+    columns = {
+        col["name"]: np.frombuffer(
+            data,
+            dtype=col["dtype"],
+            count=header["length"],
+            offset=data_start + col["offset"],
+        )
+        for col in header["columns"]
+    }
+    return header, columns
+
+
+class TestWriters:
+    """Test processed output formats"""
+
+    def test_columnar_roundtrip(self, tmp_path):
+        """Columns are stored as float32 buffers with their min/max in the header"""
+        df = pl.DataFrame({"x": [1.0, 2.0, 3.0], "value": [0.5, -1.0, 4.0]})
+        path = str(tmp_path / "out.columnar")
+        writers.write_columnar(df, path)
+
+        header, columns = read_columnar(path)
+        assert header["length"] == 3
+        assert [c["name"] for c in header["columns"]] == ["x", "value"]
+        assert header["columns"][1]["min"] == -1.0
+        assert header["columns"][1]["max"] == 4.0
+        np.testing.assert_array_equal(columns["value"], [0.5, -1.0, 4.0])
+
+    def test_msgpack_legacy_rows(self, tmp_path):
+        """The legacy format keeps the row-wise layout"""
+        df = pl.DataFrame({"x": [1.0, 2.0], "y": [3.0, 4.0]})
+        path = str(tmp_path / "out.msgpack")
+        writers.write_msgpack(df, path)
+
+        with open(path, "rb") as f:
+            data = msgpack.unpackb(f.read())
+        assert data == {"columns": ["x", "y"], "rows": [[1.0, 3.0], [2.0, 4.0]]}
+
+    def test_vertex_interleaved(self, tmp_path):
+        """Vertices interleave the axis columns with the remaining attributes"""
+        df = pl.DataFrame(
+            {"a": [1.0, 2.0], "y": [3.0, 4.0], "z": [5.0, 6.0], "v": [7.0, 8.0]}
+        )
+        path = str(tmp_path / "out.vertex")
+        writers.write_vertex(df, path, ["a", "y", "z"])
+
+        with open(path, "rb") as f:
+            data = f.read()
+        assert data[:8] == writers.VERTEX_MAGIC
+        (desc_len,) = struct.unpack("<I", data[8:12])
+        descriptor = json.loads(data[12 : 12 + desc_len])
+        assert descriptor["stride"] == 16
+        assert descriptor["bounds"] == {"min": [1.0, 3.0, 5.0], "max": [2.0, 4.0, 6.0]}
+        start = 12 + desc_len
+        start += -start % writers.VERTEX_ALIGNMENT
+        vertices = np.frombuffer(data, dtype="<f4", offset=start).reshape(2, 4)
+        np.testing.assert_array_equal(vertices, [[1, 3, 5, 7], [2, 4, 6, 8]])
+
+    def test_vertex_blocks_without_finite_values(self, tmp_path):
+        """Blocks whose axis values are all non-finite get null bounds"""
+        df = pl.DataFrame(
+            {
+                "x": [np.nan, np.inf, 1.0, 2.0],
+                "y": [1.0, np.nan, 3.0, 4.0],
+                "z": [5.0, 6.0, 7.0, 8.0],
+            }
+        )
+        blocks = morton.block_bounds(df, ["x", "y", "z"], block_rows=2)
+        assert blocks[0]["min"] == [None, 1.0, 5.0]
+        assert blocks[0]["max"] == [None, 1.0, 6.0]
+        assert blocks[1]["min"] == [1.0, 3.0, 7.0]
+        path = str(tmp_path / "out.vertex")
+        writers.write_vertex(df, path, ["x", "y", "z"], blocks=blocks)
+
+        with open(path, "rb") as f:
+            data = f.read()
+        (desc_len,) = struct.unpack("<I", data[8:12])
+
+        def reject(constant):
+            raise ValueError(f"invalid JSON constant {constant}")
+
+        descriptor = json.loads(data[12 : 12 + desc_len], parse_constant=reject)
+        assert descriptor["blocks"] == blocks
+
+    def test_columnar_compressed_shuffled(self, tmp_path):
+        """Compressed columnar artifacts store byte-shuffled columns"""
+        values = np.linspace(0, 1, 100, dtype="<f4")
+        df = pl.DataFrame({"v": values})
+        path = str(tmp_path / "out.columnar.zst")
+        writers.write_columnar(df, path, compression="zstd")
+
+        plain_path = str(tmp_path / "out.columnar")
+        with open(plain_path, "wb") as f:
+            for chunk in iter_decompressed(path, "zstd"):
+                f.write(chunk)
+        header, columns = read_columnar(plain_path)
+        assert header["shuffle"] is True
+        unshuffled = columns["v"].view("u1").reshape(4, -1).T.copy().view("<f4")
+        np.testing.assert_array_equal(unshuffled.ravel(), values)
+
+    def test_columnar_quantized(self, tmp_path):
+        """uint16 columns record scale/offset and report their error"""
+        values = np.linspace(-5, 5, 1000, dtype="<f4")
+        df = pl.DataFrame({"v": values})
+        path = str(tmp_path / "out.columnar")
+        report = writers.write_columnar(df, path, quantization="uint16")
+
+        header, columns = read_columnar(path)
+        column = header["columns"][0]
+        assert column["dtype"] == "<u2"
+        scale = column["quantization"]["scale"]
+        restored = columns["v"] * scale + column["quantization"]["offset"]
+        max_error = np.abs(restored - values).max()
+        assert max_error <= scale / 2 + 1e-6
+        assert report["v"]["max_abs_error"] == pytest.approx(max_error, abs=1e-6)
+
+    def test_columnar_float16_out_of_range(self, tmp_path):
+        """float16 keeps columns beyond its range as float32 with a finite report"""
+        df = pl.DataFrame(
+            {
+                "mass": np.array([1e5, -2e6, 3.5, np.nan], dtype="<f4"),
+                "v": np.array([0.1, 1.5, -2.0, np.inf], dtype="<f4"),
+            }
+        )
+        path = str(tmp_path / "out.columnar")
+        report = writers.write_columnar(df, path, quantization="float16")
+
+        header, columns = read_columnar(path)
+        dtypes = {column["name"]: column["dtype"] for column in header["columns"]}
+        assert dtypes == {"mass": "<f4", "v": "<f2"}
+        np.testing.assert_array_equal(columns["mass"], df["mass"].to_numpy())
+        assert report["mass"] == {"max_abs_error": 0.0, "rms_error": 0.0}
+        assert all(
+            np.isfinite(error)
+            for errors in report.values()
+            for error in errors.values()
+        )
+        json.dumps(report, allow_nan=False)
+
+    @pytest.mark.parametrize("compression", ["none", "zstd"])
+    def test_columnar_projection(self, tmp_path, monkeypatch, compression):
+        """Projections read a column subset and a row range only"""
+        # Unshuffle compressed columns over several windows
+        monkeypatch.setattr(readers, "PROJECTION_ROWS", 2)
+        df = pl.DataFrame(
+            {
+                "x": np.arange(100, dtype="<f4"),
+                "y": np.arange(100, 200, dtype="<f4"),
+                "z": np.arange(200, 300, dtype="<f4"),
+            }
+        )
+        path = str(tmp_path / "out.columnar")
+        if compression != "none":
+            path += ".zst"
+        writers.write_columnar(df, path, compression=compression)
+
+        size, content = readers.columnar_projection(path, ["z", "x"], 10, 5)
+        data = b"".join(content)
+        assert len(data) == size
+
+        header, columns = read_columnar(data=data)
+        assert header["length"] == 5
+        assert header["total_length"] == 100
+        assert header["row_offset"] == 10
+        assert header["shuffle"] is False
+        assert list(columns) == ["x", "z"]
+        assert header["columns"][1]["max"] == 299.0
+        np.testing.assert_array_equal(columns["x"], np.arange(10, 15))
+        np.testing.assert_array_equal(columns["z"], np.arange(210, 215))
+
+    def test_projection_rejects_unknown_columns(self, tmp_path):
+        """Unknown column names are rejected before any data is read"""
+        path = str(tmp_path / "out.columnar")
+        writers.write_columnar(pl.DataFrame({"x": [1.0]}), path)
+        with pytest.raises(ValueError):
+            readers.columnar_projection(path, ["nope"])
+
+    def test_arrow_record_batches(self, tmp_path):
+        """Arrow artifacts hold batch_size-row record batches and can be projected"""
+        df = pl.DataFrame({"x": np.arange(10, dtype="<f4"), "y": np.ones(10)})
+        path = str(tmp_path / "out.arrow")
+        writers.write_arrow(df, path, batch_size=4)
+
+        restored = pl.read_ipc(path, memory_map=True, rechunk=False)
+        assert restored.n_chunks() == 3
+        assert restored.equals(df)
+
+        compressed_path = str(tmp_path / "compressed.arrow")
+        writers.write_arrow(df, compressed_path, compression="zstd")
+        assert pl.read_ipc(compressed_path, memory_map=False).equals(df)
+
+        size, content = readers.arrow_projection(path, ["x"], 8)
+        data = b"".join(content)
+        assert len(data) == size
+        projected = pl.read_ipc(data)
+        assert projected.columns == ["x"]
+        assert projected["x"].to_list() == [8.0, 9.0]
+
+    def test_chunk_writer_appends(self, tmp_path, monkeypatch):
+        """Published chunks are appended and indexed as columnar artifacts"""
+        monkeypatch.setattr(chunks, "PARTIAL_DIR", str(tmp_path))
+        writer = chunks.ChunkWriter(7)
+        writer.append(pl.DataFrame({"x": [1.0, 2.0]}))
+        writer.append(pl.DataFrame({"x": []}, schema={"x": pl.Float32}))
+        writer.append(pl.DataFrame({"x": [3.0]}))
+
+        index = chunks.read_chunk_index(7)
+        assert [chunk["rows"] for chunk in index["chunks"]] == [2, 1]
+        chunk = index["chunks"][1]
+        with open(chunks.chunk_data_path(7), "rb") as f:
+            f.seek(chunk["offset"])
+            data = f.read(chunk["nbytes"])
+        _, columns = read_columnar(data=data)
+        np.testing.assert_array_equal(columns["x"], [3.0])
+
+        chunks.remove_chunks(7)
+        assert chunks.read_chunk_index(7) is None
+
+    def test_chunk_writer_resumes(self, tmp_path, monkeypatch):
+        """A writer with the same key resumes from the checkpointed chunks"""
+        monkeypatch.setattr(chunks, "PARTIAL_DIR", str(tmp_path))
+        writer = chunks.ChunkWriter(7, key="a")
+        writer.append(pl.DataFrame({"z": [1, 2]}, schema={"z": pl.UInt16}))
+        writer.append(pl.DataFrame({"z": []}, schema={"z": pl.UInt16}))
+        # Bytes of a chunk whose index update was lost
+        with open(chunks.chunk_data_path(7), "ab") as f:
+            f.write(b"partial")
+
+        resumed = chunks.ChunkWriter(7, key="a")
+        assert resumed.completed == 2
+        restored = resumed.restore()
+        assert len(restored) == 1
+        assert restored[0].schema == {"z": pl.UInt16}
+        assert restored[0]["z"].to_list() == [1, 2]
+        resumed.append(pl.DataFrame({"z": [3]}, schema={"z": pl.UInt16}))
+        assert [frame["z"].to_list() for frame in resumed.restore()] == [[1, 2], [3]]
+
+        # Another configuration starts over
+        assert chunks.ChunkWriter(7, key="b").completed == 0
+        assert chunks.read_chunk_index(7)["chunks"] == []
+
+    def test_fits_chunks_resume_without_converting(self, tmp_path, monkeypatch):
+        """Resumed FITS jobs skip checkpointed slabs before converting them"""
+        monkeypatch.setattr(cache, "RAW_CACHE_DIR", str(tmp_path / "raw"))
+        cube = np.zeros((4, 5, 3), dtype="<f4")
+        cube[:, 0] = 1.0
+        cube[1, 2, 1] = np.nan
+        cube[:, 3] = 2.0
+        cube[2, 4, 0] = 3.0
+        path = str(tmp_path / "cube.fits")
+        fits.PrimaryHDU(cube).writeto(path)
+
+        converted = []
+        from_pandas = pl.from_pandas
+        monkeypatch.setattr(
+            pl, "from_pandas", lambda df: converted.append(1) or from_pandas(df)
+        )
+        resumed = list(processors.iter_fits_chunks(path, start=2))
+        assert [slab["z"][0] for slab in resumed] == [4]
+        assert len(converted) == 1
+        # A partial conversion is not cached
+        assert cache.read_cached_variable(path, "z") is None
+
+        full = list(processors.iter_fits_chunks(path))
+        assert [slab["z"][0] for slab in full] == [0, 3, 4]
+        assert full[2].equals(resumed[0])
+        cached = list(processors.iter_fits_chunks(path, start=2))
+        assert cached[0].equals(resumed[0])
+
+    def test_hdf5_conversion_stops_between_variables(self, tmp_path, monkeypatch):
+        """A stopped HDF5 conversion keeps the variables it already cached"""
+        monkeypatch.setattr(cache, "RAW_CACHE_DIR", str(tmp_path / "raw"))
+        source = tmp_path / "sim.hdf5"
+        source.write_bytes(b"source")
+        converted = []
+
+        class Simulation:
+            def physical_units(self):
+                pass
+
+            def __getitem__(self, name):
+                converted.append(name)
+                return np.arange(3, dtype="f8")
+
+        @contextmanager
+        def load_data(path):
+            yield Simulation()
+
+        monkeypatch.setattr(processors, "load_data", load_data)
+        file = FileRead(
+            id=1,
+            type="hdf5",
+            name="sim",
+            path=str(source),
+            variables=[
+                VariableRead(var_name=name, unit="", selected=True)
+                for name in ("mass", "rho")
+            ],
+        )
+        token = type("Token", (), {"is_set": lambda _: bool(converted)})()
+        with pytest.raises(processors.ProcessingCancelled):
+            processors.pynbody_to_dataframe(file, cancel_token=token)
+        assert converted == ["mass"]
+
+        df = processors.pynbody_to_dataframe(file)
+        assert converted == ["mass", "rho"]
+        assert df.columns == ["mass", "rho"]
+
+    def test_downsampling_many_small_chunks(self, tmp_path, monkeypatch):
+        """Downsampling keeps the same fraction of rows however small the chunks"""
+        monkeypatch.setattr(cache, "RAW_CACHE_DIR", str(tmp_path / "raw"))
+        monkeypatch.setattr(processors, "ROW_BLOCK", 999)
+        source = tmp_path / "sim.hdf5"
+        source.write_bytes(b"source")
+        path = str(source)
+        rows = 2000 * 999
+        cache.write_cached_variable(path, pl.Series("x", np.arange(rows, dtype="f4")))
+        file = FileRead(
+            id=1,
+            type="hdf5",
+            name="sim",
+            path=path,
+            downsampling=0.001,
+            variables=[VariableRead(var_name="x", unit="", selected=True)],
+        )
+
+        chunks = list(processors.iter_chunks(file))
+        assert len(chunks) == 2000
+        kept = sum(chunk.height for chunk in chunks)
+        assert abs(kept - rows * 0.001) < 5 * (rows * 0.001) ** 0.5
+        # Chunks are sampled reproducibly, also when a run resumes
+        resumed = list(processors.iter_chunks(file, start=1000))
+        assert all(a.equals(b) for a, b in zip(chunks[1000:], resumed))
+
+    def test_octree_tiles(self, tmp_path):
+        """Octree nodes partition the rows and stay within their cell bounds"""
+        rng = np.random.default_rng(0)
+        df = pl.DataFrame(
+            {
+                "x": rng.random(5000, dtype="f4"),
+                "y": rng.random(5000, dtype="f4"),
+                "z": rng.random(5000, dtype="f4"),
+                "id": np.arange(5000, dtype="f4"),
+            }
+        )
+        path = str(tmp_path / "out.octree")
+        report = octree.write_octree(df, path, ["x", "y", "z"], node_points=100)
+
+        index = octree.read_octree_index(path)
+        assert report["octree"]["nodes"] == len(index["nodes"])
+        assert index["nodes"][0]["count"] == 100
+        with open(path, "rb") as f:
+            data = f.read()
+        ids = []
+        for node in index["nodes"]:
+            tile = data[node["offset"] : node["offset"] + node["nbytes"]]
+            _, columns = read_columnar(data=tile)
+            for axis, name in enumerate("xyz"):
+                assert columns[name].min() >= node["bounds"]["min"][axis] - 1e-6
+                assert columns[name].max() <= node["bounds"]["max"][axis] + 1e-6
+            ids.extend(columns["id"].tolist())
+        assert sorted(ids) == list(range(5000))
+
+    def test_morton_blocks(self, tmp_path):
+        """Morton-ordered output records the bounding box of each block"""
+        rng = np.random.default_rng(0)
+        df = pl.DataFrame({axis: rng.random(1000, dtype="f4") for axis in "xyz"})
+        df = morton.morton_sort(df, ["x", "y", "z"])
+        blocks = morton.block_bounds(df, ["x", "y", "z"], block_rows=300)
+        path = str(tmp_path / "out.columnar")
+        writers.write_columnar(df, path, blocks=blocks)
+
+        header, columns = read_columnar(path)
+        codes = morton.morton_codes([columns[axis] for axis in "xyz"])
+        assert np.all(np.diff(codes.astype(np.int64)) >= 0)
+        assert [(b["row"], b["rows"]) for b in header["blocks"]] == [
+            (0, 300),
+            (300, 300),
+            (600, 300),
+            (900, 100),
+        ]
+        for block in header["blocks"]:
+            rows = slice(block["row"], block["row"] + block["rows"])
+            for axis, name in enumerate("xyz"):
+                assert columns[name][rows].min() == block["min"][axis]
+                assert columns[name][rows].max() == block["max"][axis]